@@ -24,14 +24,14 @@ export default function AdminDashboard() {
   useEffect(() => {
     Promise.all([
       axios.get(`${FLIGHT_URL}/api/flights`).catch(() => ({ data: { flights: [] } })),
-      axios.get(`${IDENTITY_URL}/api/admin/users`, { headers }).catch(() => ({ data: { users: [] } })),
+      // Only the count is shown: ask for the total and the smallest page.
+      axios.get(`${IDENTITY_URL}/api/admin/users?fields=id&limit=1&total=true`, { headers }).catch(() => ({ data: { total: 0 } })),
       axios.get(`${BOOKING_URL}/api/admin/bookings`, { headers }).catch(() => ({ data: { bookings: [] } })),
     ])
       .then(([flightRes, userRes, bookingRes]) => {
         const flights = flightRes.data?.flights || []
-        const users = userRes.data?.users || []
         const bookings = bookingRes.data?.bookings || []
-        setStats({ flights: flights.length, users: users.length, bookings: bookings.length })
+        setStats({ flights: flights.length, users: userRes.data?.total || 0, bookings: bookings.length })
         setRecentBookings(bookings.slice(0, 8))
         setLoading(false)
       })
@@ -0,0 +1,127 @@
+# Per-request cost of the identity middleware stack, before and after the
+# pure-ASGI rewrite (middleware.py).
+#
+# Drives small FastAPI apps directly through the ASGI interface — no
+# sockets, no server — with the same layers main.py uses (OTEL
+# instrumentation, CORS, request ID), so the numbers are middleware
+# overhead plus a trivial handler:
+#
+#   bare    no middleware at all (the baseline subtracted below)
+#   before  CORS + OTEL + @app.middleware("http") request ID
+#   after   CORS + OTEL + RequestIDMiddleware + FastLaneMiddleware
+#
+# Usage (from code/identity):
+#   python bench/middleware.py [--requests 20000]
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi import FastAPI, Request  # noqa: E402
+from fastapi.middleware.cors import CORSMiddleware  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor  # noqa: E402
+from opentelemetry.sdk.trace import TracerProvider  # noqa: E402
+
+from middleware import FastLaneMiddleware, RequestIDMiddleware  # noqa: E402
+
+PATHS = ("/healthz", "/api/ping")
+
+
+def build(variant: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/healthz")
+    async def healthz():
+        return JSONResponse({"status": "ok"})
+
+    @app.get("/api/ping")
+    async def ping():
+        return JSONResponse({"status": "ok"})
+
+    if variant == "bare":
+        return app
+    # An SDK provider with no span processor: spans are created and
+    # ended, nothing is exported.
+    FastAPIInstrumentor.instrument_app(app, tracer_provider=TracerProvider())
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+        expose_headers=["X-Request-ID"],
+    )
+    if variant == "before":
+        @app.middleware("http")
+        async def add_request_id(request: Request, call_next):
+            request_id = request.headers.get("X-Request-ID", str(uuid.uuid4()))
+            request.state.request_id = request_id
+            response = await call_next(request)
+            response.headers["X-Request-ID"] = request_id
+            return response
+    else:
+        app.add_middleware(RequestIDMiddleware)
+        app.add_middleware(FastLaneMiddleware, fast_app=app.router, paths=("/healthz",))
+    return app
+
+
+async def drive(app: FastAPI, path: str, n: int) -> float:
+    """Seconds per request over `n` sequential requests to `path`."""
+    never = asyncio.Event()
+
+    def receiver():
+        # Like a server: the request body once, then block until the
+        # client goes away (it never does here).
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await never.wait()
+        return receive
+
+    async def send(message):
+        pass
+
+    def scope():
+        return {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+            "root_path": "", "query_string": b"", "server": ("bench", 80),
+            "client": ("127.0.0.1", 12345),
+            "headers": [(b"host", b"bench"), (b"user-agent", b"bench")],
+        }
+
+    for _ in range(min(n, 1000)):  # warm-up: builds the middleware stack
+        await app(scope(), receiver(), send)
+    start = time.perf_counter()
+    for _ in range(n):
+        await app(scope(), receiver(), send)
+    return (time.perf_counter() - start) / n
+
+
+async def main(n: int):
+    results = {}
+    for variant in ("bare", "before", "after"):
+        app = build(variant)
+        for path in PATHS:
+            results[variant, path] = await drive(app, path, n)
+    print(f"{'path':<12}{'variant':<8}{'us/req':>10}{'overhead us':>14}")
+    for path in PATHS:
+        base = results["bare", path]
+        for variant in ("bare", "before", "after"):
+            t = results[variant, path]
+            print(f"{path:<12}{variant:<8}{t * 1e6:>10.1f}{(t - base) * 1e6:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=20000)
+    asyncio.run(main(parser.parse_args().requests))
@@ -0,0 +1,149 @@
+# Cost of the hot identity reads, before and after prepared statements and
+# projected records (prepared.py, queries.py).
+#
+# decode (no database needed): building one profile row the way each
+# version does, from values as psycopg2 hands them over —
+#
+#   before  a RealDictRow with every users column, filled the way
+#           RealDictCursor's fetchone() fills it (SELECT *)
+#   after   a queries.Profile from the projected tuple
+#
+# reported as time per row and bytes retained per row (tracemalloc, with
+# --rows rows alive at once, like a full profile cache).
+#
+# db (with --dsn): round-trip latency against a real Postgres for the
+# profile and login lookups, the old text SQL + RealDictCursor against
+# queries.user_by_id / user_by_email on a connection that has prepared
+# them. Uses the first user in the table; nothing is written.
+#
+# Usage (from code/identity):
+#   python bench/queries.py [--rows 10000] [--dsn postgresql://...] [--calls 5000]
+import argparse
+import datetime
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from psycopg2.extras import RealDictCursor, RealDictRow  # noqa: E402
+
+import queries  # noqa: E402
+
+# users, in table order (init.sql).
+ALL_COLUMNS = ("id", "email", "password_hash", "first_name", "last_name", "passport_number",
+               "loyalty_tier", "role", "is_active", "created_at", "updated_at")
+_MAPPING = list(ALL_COLUMNS)
+
+
+def sample_values(i: int) -> dict:
+    now = datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=i)
+    return {
+        "id": uuid.UUID(int=i), "email": f"user{i}@example.com",
+        "password_hash": "$2b$12$" + "x" * 53, "first_name": "Ada", "last_name": "Lovelace",
+        "passport_number": f"P{i:08d}", "loyalty_tier": "GOLD", "role": "PASSENGER",
+        "is_active": True, "created_at": now, "updated_at": now,
+    }
+
+
+def decode_before(values):
+    # What psycopg2's C row builder does for a RealDictCursor: make the row,
+    # then row[i] = value per column, which RealDictRow.__setitem__ maps
+    # to the column name.
+    row = RealDictRow()
+    OrderedDict.__setitem__(row, RealDictRow, _MAPPING)
+    for i, value in enumerate(values):
+        row[i] = value
+    return row
+
+
+def decode_after(values):
+    return queries.Profile(*values)
+
+
+def decode(n: int):
+    samples = [sample_values(i) for i in range(n)]
+    variants = {
+        "before": (decode_before, [tuple(s[c] for c in ALL_COLUMNS) for s in samples]),
+        "after": (decode_after, [tuple(s[c] for c in queries.Profile.__slots__) for s in samples]),
+    }
+    print(f"{'decode':<10}{'ns/row':>10}{'bytes/row':>12}")
+    for name, (fn, rows) in variants.items():
+        for values in rows[:1000]:  # warm-up
+            fn(values)
+        start = time.perf_counter()
+        for values in rows:
+            fn(values)
+        elapsed = (time.perf_counter() - start) / n
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        kept = [fn(values) for values in rows]
+        size = (tracemalloc.get_traced_memory()[0] - before) / n
+        tracemalloc.stop()
+        del kept
+        print(f"{name:<10}{elapsed * 1e9:>10.0f}{size:>12.0f}")
+
+
+def old_user_by_id(conn, user_id):
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
+    row = cur.fetchone()
+    cur.close()
+    return row
+
+
+def old_user_by_email(conn, email):
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute("SELECT * FROM users WHERE email = %s", (email,))
+    row = cur.fetchone()
+    cur.close()
+    return row
+
+
+def db(dsn: str, calls: int):
+    import psycopg2
+
+    from db import Connection
+
+    conn = psycopg2.connect(dsn, connection_factory=Connection)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT id, email FROM users ORDER BY created_at LIMIT 1")
+    user = cur.fetchone()
+    cur.close()
+    if user is None:
+        print("db: users table is empty, skipped")
+        return
+    user_id, email = str(user[0]), user[1]
+    queries.warm_up(conn)
+    cases = {
+        "user_by_id": ((old_user_by_id, queries.user_by_id), user_id),
+        "user_by_email": ((old_user_by_email, queries.user_by_email), email),
+    }
+    print(f"\n{'db':<16}{'before us':>11}{'after us':>11}")
+    for name, (fns, arg) in cases.items():
+        results = []
+        for fn in fns:
+            for _ in range(min(calls, 500)):  # warm-up; also gets the generic plan
+                fn(conn, arg)
+            start = time.perf_counter()
+            for _ in range(calls):
+                fn(conn, arg)
+            results.append((time.perf_counter() - start) / calls)
+        print(f"{name:<16}{results[0] * 1e6:>11.1f}{results[1] * 1e6:>11.1f}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--dsn", default=os.getenv("BENCH_DSN"))
+    parser.add_argument("--calls", type=int, default=5000)
+    args = parser.parse_args()
+    decode(args.rows)
+    if args.dsn:
+        db(args.dsn, args.calls)
@@ -0,0 +1,131 @@
+# Per-request cost of each tracing configuration (telemetry.py).
+#
+# Drives a small FastAPI app directly through the ASGI interface, like
+# bench/middleware.py. The handler stands in for a typical identity request:
+# two "queries", each a CLIENT span when query spans are on (the psycopg2
+# instrumentation needs a live database, so the spans are opened by hand).
+# Spans go through the real sampler, TailKeepProcessor and
+# BatchSpanProcessor into an exporter that discards them, so export
+# batching is included but not the network.
+#
+#   off            OTEL_TRACING_LEVEL=off: no provider, no middleware
+#   minimal        server spans only, every trace sampled
+#   full           + query spans, every trace sampled (the old default)
+#   full@0.1       full, 10% sampled, errors/slow kept (RECORD_ONLY rest)
+#   full@0.1-drop  full, 10% sampled, unsampled traces not recorded
+#
+# Usage (from code/identity):
+#   python bench/tracing.py [--requests 20000]
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from opentelemetry import trace  # noqa: E402
+from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor  # noqa: E402
+from opentelemetry.sdk.trace import TracerProvider  # noqa: E402
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult  # noqa: E402
+
+from telemetry import TailKeepProcessor, make_sampler  # noqa: E402
+
+# name -> (server spans, query spans, ratio, keep errors/slow)
+VARIANTS = {
+    "off": None,
+    "minimal": (True, False, 1.0, False),
+    "full": (True, True, 1.0, False),
+    "full@0.1": (True, True, 0.1, True),
+    "full@0.1-drop": (True, True, 0.1, False),
+}
+
+
+class NullExporter(SpanExporter):
+    def export(self, spans):
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        pass
+
+
+def build(variant: str):
+    app = FastAPI()
+    config = VARIANTS[variant]
+    provider = None
+    tracer = trace.NoOpTracer()
+    if config is not None:
+        _, query_spans, ratio, tail = config
+        provider = TracerProvider(sampler=make_sampler(ratio, record_unsampled=tail))
+        processor = BatchSpanProcessor(NullExporter())
+        if tail:
+            processor = TailKeepProcessor(processor, slow_ms=500)
+        provider.add_span_processor(processor)
+        if query_spans:
+            tracer = provider.get_tracer("bench")
+        FastAPIInstrumentor.instrument_app(app, tracer_provider=provider)
+
+    @app.get("/api/users/me")
+    async def me():
+        for statement in ("user_version", "user_by_id"):
+            with tracer.start_as_current_span(statement, kind=trace.SpanKind.CLIENT):
+                pass
+        return JSONResponse({"status": "ok"})
+
+    return app, provider
+
+
+async def drive(app: FastAPI, path: str, n: int) -> float:
+    """Seconds per request over `n` sequential requests to `path`."""
+    never = asyncio.Event()
+
+    def receiver():
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await never.wait()
+        return receive
+
+    async def send(message):
+        pass
+
+    def scope():
+        return {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+            "root_path": "", "query_string": b"", "server": ("bench", 80),
+            "client": ("127.0.0.1", 12345),
+            "headers": [(b"host", b"bench"), (b"user-agent", b"bench")],
+        }
+
+    for _ in range(min(n, 1000)):  # warm-up: builds the middleware stack
+        await app(scope(), receiver(), send)
+    start = time.perf_counter()
+    for _ in range(n):
+        await app(scope(), receiver(), send)
+    return (time.perf_counter() - start) / n
+
+
+async def main(n: int):
+    results = {}
+    for variant in VARIANTS:
+        app, provider = build(variant)
+        results[variant] = await drive(app, "/api/users/me", n)
+        if provider is not None:
+            provider.shutdown()
+    base = results["off"]
+    print(f"{'level':<15}{'us/req':>10}{'overhead us':>14}")
+    for variant, t in results.items():
+        print(f"{variant:<15}{t * 1e6:>10.1f}{(t - base) * 1e6:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=20000)
+    asyncio.run(main(parser.parse_args().requests))
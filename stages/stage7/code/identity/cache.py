@@ -0,0 +1,447 @@
+# User profile cache for the identity service.
+#
+# GET /api/users/me and GET /api/users/{id} used to run
+# `SELECT * FROM users WHERE id = %s` on every call, and booking calls the
+# second one for every reservation it creates. ProfileCache keeps recently
+# read user rows in memory so reads for hot users never reach Postgres:
+#
+#   - TTL: an entry is served for at most `ttl` seconds after it was loaded.
+#     This bounds staleness for writes this process doesn't see (a manual
+#     UPDATE in psql, or another worker or replica while invalidations
+#     aren't being broadcast — see below).
+#   - LRU: at most `max_size` entries, least-recently-used evicted first.
+#   - write-through invalidation: every handler that changes a user row
+#     calls invalidate(user_id) before it responds, so the pod that served
+#     the write never serves the old profile afterwards.
+#   - no stale refill: a read that started before an invalidate() must not
+#     put its (now stale) row back. load() snapshots `generation` before the
+#     query and put() drops the row if anything was invalidated meanwhile.
+#
+# SharedProfileCache is an optional second tier in Redis (REDIS_URL), the
+# same cache-aside pattern search uses. A per-pod cache across 3-20
+# replicas mostly misses; the shared tier means a profile loaded by one
+# replica is a hit on all of them. Lookups go local -> Redis -> Postgres:
+#
+#   - graceful degradation: connect() pings with a bounded timeout and
+#     leaves the tier disabled if Redis is down; at runtime every Redis
+#     error (1s socket timeout) counts as a miss and the read goes to
+#     Postgres. Redis can slow identity down, never fail it.
+#   - no stale refill across replicas either: the local generation only
+#     covers invalidations this process has heard of, and a broadcast can
+#     arrive after another replica's slow read has already written its row
+#     back. So every key has a version counter in Redis
+#     (VERSION_PREFIX + key) that invalidation bumps; an entry carries the
+#     version that was current when its row was read, and get() (one MGET
+#     for both) ignores entries whose version is no longer current. The
+#     stale entry is never served and the next refill overwrites it.
+#   - invalidation bumps the version, deletes the Redis key too, and is
+#     broadcast on the INVALIDATION_CHANNEL pub/sub channel. Every other worker of every
+#     replica drops its local copy. Without that, GET /api/users/me after
+#     a PUT would usually hit another process and get the old profile and
+#     ETag.
+#   - while invalidations can't be received (no shared tier, Redis down,
+#     subscription lost) the local tier keeps entries for at most
+#     `unsynced_ttl` (a second or two) instead of `ttl`. The local tier is
+#     cleared whenever the subscription starts or drops, since messages may
+#     have been missed.
+#   - REDIS_URL=memory:// uses MemoryRedis, an in-process stand-in, so the
+#     shared code path can be exercised locally without a Redis server.
+#
+# cache_hits_total / cache_misses_total{service="identity"} and the
+# X-Cache: HIT|MISS header count reads served by either tier vs reads
+# that reached Postgres, matching search.
+#
+# Rows are cached without password_hash — nothing that reads a profile
+# needs it and it shouldn't sit in memory (or Redis) for `ttl` seconds.
+# Only found users are cached; a miss for an unknown ID pays the query
+# every time. All access happens on the event loop thread, so there is no
+# lock.
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+import redis.asyncio as redis
+
+from metrics import (
+    CACHE_HITS,
+    CACHE_MISSES,
+    MULTIPROCESS,
+    PROFILE_CACHE_EVICTIONS,
+    PROFILE_CACHE_HIT_RATIO,
+    PROFILE_CACHE_HITS,
+    PROFILE_CACHE_MISSES,
+    PROFILE_CACHE_SIZE,
+    SHARED_CACHE_ERRORS,
+)
+
+
+def cache_key(user_id):
+    """Canonical key for a user ID, or None if it isn't a UUID (those can
+    never match a row, so they bypass the cache)."""
+    try:
+        return str(uuid.UUID(str(user_id)))
+    except ValueError:
+        return None
+
+
+def _public_row(row):
+    # Records (queries.Profile) are projected already and are kept as is.
+    if "password_hash" not in row:
+        return row
+    return {k: v for k, v in row.items() if k != "password_hash"}
+
+
+class ProfileCache:
+    def __init__(self, max_size: int, ttl: float, shared=None, unsynced_ttl: float = 2.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.unsynced_ttl = unsynced_ttl
+        self.shared = shared
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (row, expires_at)
+        if not MULTIPROCESS:
+            PROFILE_CACHE_HIT_RATIO.set_function(self.hit_ratio)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl > 0
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, user_id):
+        """Return the cached row for `user_id`, or None. Treat the returned
+        dict as read-only — it is shared between requests."""
+        key = cache_key(user_id)
+        if not self.enabled or key is None:
+            return None
+        row = self._lookup(key)
+        if row is None:
+            self._miss()
+            return None
+        self.hits += 1
+        PROFILE_CACHE_HITS.inc()
+        self._publish_ratio()
+        return row
+
+    def peek(self, user_id):
+        """Like get(), but not counted as a hit or miss: for checks that
+        fall back to get() (main.not_modified, then load_user), so one
+        request counts once."""
+        key = cache_key(user_id)
+        if not self.enabled or key is None:
+            return None
+        return self._lookup(key)
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        row, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            PROFILE_CACHE_EVICTIONS.labels(reason="expired").inc()
+            PROFILE_CACHE_SIZE.set(len(self._entries))
+            return None
+        self._entries.move_to_end(key)
+        return row
+
+    def put(self, user_id, row: dict, generation: int = None):
+        """Cache `row`. Pass the `generation` read before the row was
+        fetched; if an invalidation happened since, the row is dropped."""
+        key = cache_key(user_id)
+        if not self.enabled or key is None or row is None:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        row = _public_row(row)
+        synced = self.shared is not None and self.shared.subscribed
+        ttl = self.ttl if synced else min(self.ttl, self.unsynced_ttl)
+        self._entries[key] = (row, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            PROFILE_CACHE_EVICTIONS.labels(reason="lru").inc()
+        PROFILE_CACHE_SIZE.set(len(self._entries))
+
+    async def invalidate(self, user_id):
+        """Drop `user_id` here, in the shared tier and, through the
+        broadcast, in every other process."""
+        key = cache_key(user_id)
+        self.invalidate_local(key)
+        if self.shared is not None and key is not None:
+            await self.shared.delete(key)
+            await self.shared.publish_invalidation(key)
+
+    def invalidate_local(self, key):
+        """Drop `key` from this process only (a broadcast from another one)."""
+        # Bump the generation even if the key isn't cached: a load for it
+        # may be in flight right now.
+        self.generation += 1
+        if key is not None and self._entries.pop(key, None) is not None:
+            PROFILE_CACHE_EVICTIONS.labels(reason="invalidated").inc()
+            PROFILE_CACHE_SIZE.set(len(self._entries))
+
+    def clear(self):
+        """Drop every entry, e.g. after invalidations may have been missed."""
+        self.generation += 1
+        if self._entries:
+            PROFILE_CACHE_EVICTIONS.labels(reason="invalidated").inc(len(self._entries))
+            self._entries.clear()
+            PROFILE_CACHE_SIZE.set(0)
+
+    def listen(self):
+        """Apply invalidations broadcast by other processes (see
+        SharedProfileCache.listen); a no-op without the shared tier."""
+        if self.shared is not None:
+            self.shared.listen(self.invalidate_local, self.clear)
+
+    async def load(self, user_id, fetch):
+        """Return (row, hit): the row for `user_id` from the local tier, the
+        shared tier or `await fetch(user_id)`, caching whatever was found."""
+        row = self.get(user_id)
+        if row is not None:
+            CACHE_HITS.labels(service="identity").inc()
+            return row, True
+        key = cache_key(user_id)
+        generation = self.generation
+        version = None
+        if self.shared is not None and key is not None:
+            row, version = await self.shared.get(key)
+        hit = row is not None
+        if not hit:
+            row = await fetch(user_id)
+            if row is not None and version is not None and generation == self.generation:
+                await self.shared.put(key, row, version)
+        (CACHE_HITS if hit else CACHE_MISSES).labels(service="identity").inc()
+        self.put(user_id, row, generation)
+        return row, hit
+
+    def _miss(self):
+        self.misses += 1
+        PROFILE_CACHE_MISSES.inc()
+        self._publish_ratio()
+
+    def _publish_ratio(self):
+        # A set_function gauge can't be exported across worker processes.
+        if MULTIPROCESS:
+            PROFILE_CACHE_HIT_RATIO.set(self.hit_ratio())
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class MemoryRedis:
+    """The few redis.asyncio.Redis methods SharedProfileCache uses, backed
+    by a dict. For local runs and smoke tests (REDIS_URL=memory://)."""
+
+    def __init__(self):
+        self._data = {}  # key -> (value, expires_at)
+
+    async def ping(self):
+        return True
+
+    async def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return entry[0]
+
+    async def set(self, key, value, ex=None):
+        self._data[key] = (value, time.monotonic() + ex if ex else float("inf"))
+        return True
+
+    async def mget(self, *keys):
+        return [await self.get(key) for key in keys]
+
+    async def incr(self, key):
+        value = int(await self.get(key) or 0) + 1
+        expires_at = self._data.get(key, (None, float("inf")))[1]
+        self._data[key] = (str(value).encode(), expires_at)
+        return value
+
+    async def expire(self, key, seconds):
+        if await self.get(key) is None:
+            return False
+        self._data[key] = (self._data[key][0], time.monotonic() + seconds)
+        return True
+
+    async def delete(self, *keys):
+        return sum(self._data.pop(key, None) is not None for key in keys)
+
+    async def publish(self, channel, message):
+        # No other processes share this dict, so nobody is listening.
+        return 0
+
+    async def aclose(self):
+        self._data.clear()
+
+
+class SharedProfileCache:
+    KEY_PREFIX = "identity:user:"
+    VERSION_PREFIX = "identity:user-version:"
+    INVALIDATION_CHANNEL = "identity:user:invalidated"
+    RESUBSCRIBE_DELAY = 1.0
+
+    def __init__(self, url: str, ttl: float, timeout: float = 1.0, on_error=None):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.on_error = on_error  # on_error(op, exc), e.g. to log a warning
+        self.subscribed = False
+        # Tags our own broadcasts, which the listener skips.
+        self._origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._client = None
+        self._listener = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._client is not None
+
+    async def connect(self):
+        """Connect and ping within `timeout`. Raises on failure, leaving the
+        tier disabled (every lookup falls through to Postgres)."""
+        if not self.url or self.ttl <= 0:
+            return
+        if self.url.startswith("memory://"):
+            client = MemoryRedis()
+        else:
+            client = redis.from_url(
+                self.url,
+                socket_timeout=self.timeout,
+                socket_connect_timeout=self.timeout,
+            )
+        try:
+            await asyncio.wait_for(client.ping(), self.timeout)
+        except Exception:
+            await client.aclose()
+            raise
+        self._client = client
+
+    async def status(self) -> str:
+        """disabled | ok | unreachable, for the readiness probe body."""
+        if self._client is None:
+            return "disabled"
+        try:
+            await asyncio.wait_for(self._client.ping(), self.timeout)
+        except Exception:
+            return "unreachable"
+        return "ok"
+
+    async def get(self, key: str):
+        """(row, version): the cached row (None on a miss or a stale entry)
+        and the key's current version, to hand back to put(). version is
+        None if Redis couldn't be read — don't put() then."""
+        if self._client is None:
+            return None, None
+        try:
+            raw, current = await self._client.mget(self.KEY_PREFIX + key, self.VERSION_PREFIX + key)
+        except Exception as e:
+            self._error("get", e)
+            return None, None
+        version = int(current or 0)
+        if raw is None:
+            return None, version
+        entry = json.loads(raw)
+        if entry.get("version") != version:
+            return None, version  # written from a read older than the last invalidation
+        return entry["row"], version
+
+    async def put(self, key: str, row: dict, version: int):
+        """Cache `row`, read from Postgres after get() returned `version`."""
+        if self._client is None:
+            return
+        # UUIDs and timestamps come back as strings; str(row["id"]) and
+        # friends in the handlers don't mind.
+        raw = json.dumps({"version": version, "row": dict(_public_row(row))}, default=str)
+        try:
+            await self._client.set(self.KEY_PREFIX + key, raw, ex=int(self.ttl))
+        except Exception as e:
+            self._error("set", e)
+
+    async def delete(self, key: str):
+        """Invalidate `key`: bump its version, so entries written by reads
+        that started earlier are ignored, then drop the current entry."""
+        if self._client is None:
+            return
+        try:
+            await self._client.incr(self.VERSION_PREFIX + key)
+            # Outlives any entry written from a read before the bump (as
+            # long as that read took under `ttl`), then goes back to 0.
+            await self._client.expire(self.VERSION_PREFIX + key, 2 * int(self.ttl))
+            await self._client.delete(self.KEY_PREFIX + key)
+        except Exception as e:
+            self._error("delete", e)
+
+    async def publish_invalidation(self, key: str):
+        if self._client is None:
+            return
+        try:
+            await self._client.publish(self.INVALIDATION_CHANNEL, f"{self._origin} {key}")
+        except Exception as e:
+            self._error("publish", e)
+
+    def listen(self, on_invalidate, on_resync):
+        """Subscribe in the background: on_invalidate(key) for every key
+        another process invalidates, on_resync() whenever the subscription
+        starts or drops (messages may have been missed). Resubscribes after
+        RESUBSCRIBE_DELAY on any error. MemoryRedis has no other processes
+        to hear from, so nothing is subscribed."""
+        if self._client is None or isinstance(self._client, MemoryRedis) or self._listener is not None:
+            return
+        self._listener = asyncio.create_task(self._listen(on_invalidate, on_resync))
+
+    async def _listen(self, on_invalidate, on_resync):
+        while self._client is not None:
+            pubsub = self._client.pubsub()
+            try:
+                await pubsub.subscribe(self.INVALIDATION_CHANNEL)
+                self.subscribed = True
+                on_resync()
+                while True:
+                    # A timeout under the client's socket_timeout, so an
+                    # idle channel isn't mistaken for a dead connection.
+                    message = await pubsub.get_message(ignore_subscribe_messages=True,
+                                                       timeout=self.timeout / 2)
+                    if message is None:
+                        continue
+                    origin, _, key = message["data"].decode().partition(" ")
+                    if origin != self._origin:
+                        on_invalidate(key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._error("subscribe", e)
+            finally:
+                if self.subscribed:
+                    self.subscribed = False
+                    on_resync()
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+            await asyncio.sleep(self.RESUBSCRIBE_DELAY)
+
+    async def close(self):
+        if self._listener is not None:
+            listener, self._listener = self._listener, None
+            listener.cancel()
+            try:
+                await listener
+            except asyncio.CancelledError:
+                pass
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
+
+    def _error(self, op, exc):
+        SHARED_CACHE_ERRORS.labels(op=op).inc()
+        if self.on_error is not None:
+            self.on_error(op, exc)
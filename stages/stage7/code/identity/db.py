@@ -0,0 +1,422 @@
+# Postgres connection pool for the identity service.
+#
+# psycopg2 ships SimpleConnectionPool / ThreadedConnectionPool, but neither
+# can wait for a free connection (they raise PoolError immediately when
+# exhausted), recycle old connections, or tell us how busy they are. This
+# is a small thread-safe pool that does all three:
+#
+#   - max size: connections are opened on demand, up to `max_size`.
+#     main.py's warm-up opens them up front by holding several at once
+#     (WARMUP_DB_CONNECTIONS).
+#   - acquire timeout: callers block up to `acquire_timeout` seconds for a
+#     free connection, then get PoolTimeout (mapped to 503 by main.py).
+#   - saturation stats: the executor has one thread per connection, so
+#     under load callers queue for a thread, not in getconn(). stats() and
+#     db_pool_waiters count both (`queued` + blocked in checkout), and
+#     db_pool_acquire_seconds runs from the run() / hold() call, not from
+#     the moment a thread got to getconn().
+#   - max lifetime: connections older than `max_lifetime` seconds are closed
+#     on check-in / check-out instead of being reused, so Postgres backends
+#     don't live forever (memory bloat, stale DNS after a failover).
+#
+# The FastAPI handlers are `async def`, so they must never call psycopg2
+# directly — a blocking query would freeze the whole event loop. They go
+# through `await pool.run(fn, *args)` instead, which executes `fn(conn,
+# *args)` on a dedicated thread executor sized to max_size. One thread per
+# possible connection means DB concurrency scales with I/O wait up to the
+# pool size, while the event loop keeps serving everything else.
+#
+# Work that spans several awaits on one connection — streaming a
+# server-side cursor to a client in batches — uses `async with pool.hold()
+# as held: await held.run(fn, ...)` instead: every call runs on the DB
+# executor, always on the same connection, and nothing holds a thread
+# between calls. Checking it back in doesn't queue on the DB executor,
+# which may be full of callers blocked waiting for that very connection.
+# A clean connection is returned inline; one that needs a ROLLBACK (an
+# abandoned stream) is reset on a separate single-thread executor.
+#
+# Pooled connections run in autocommit mode: a single statement commits on
+# its own and a read doesn't leave a transaction open that would need a
+# ROLLBACK round trip on check-in. Multi-statement work wraps itself in
+# `with conn:` (psycopg2 >= 2.9 opens a transaction even in autocommit).
+# Anything that turns autocommit off gets it restored on check-in.
+# Connections are db.Connection, which track the statements prepared in
+# their session (prepared.py).
+#
+# Every run() / held.run() is timed per statement function (fn.__name__):
+# db_query_wait_seconds from the call to the statement starting (executor
+# queue + checkout), db_query_duration_seconds for fn itself.
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+from metrics import (
+    DB_POOL_ACQUIRE_SECONDS,
+    DB_POOL_ACQUIRE_TIMEOUTS,
+    DB_POOL_CONNECTIONS_CLOSED,
+    DB_POOL_CONNECTIONS_OPENED,
+    DB_POOL_IDLE,
+    DB_POOL_IN_USE,
+    DB_POOL_MAX,
+    DB_POOL_WAITERS,
+    DB_QUERY_SECONDS,
+    DB_QUERY_WAIT_SECONDS,
+)
+
+
+class PoolTimeout(Exception):
+    """No pooled connection became available within acquire_timeout."""
+
+
+class Connection(extensions.connection):
+    """psycopg2 connection that remembers which prepared statements
+    (prepared.py) exist in its server session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class _Slot:
+    """A physical connection plus the bookkeeping the pool needs for it."""
+
+    __slots__ = ("conn", "created_at")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+
+
+class ConnectionPool:
+    def __init__(self, dsn: str, max_size: int = 10,
+                 acquire_timeout: float = 5.0, max_lifetime: float = 1800.0):
+        if max_size < 1:
+            raise ValueError(f"invalid pool size: max={max_size}")
+        self.dsn = dsn
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.max_lifetime = max_lifetime
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0      # open + opening connections (idle + in use)
+        self._in_use = 0
+        self._waiters = 0   # blocked in getconn()
+        self._queued = 0    # submitted, waiting for an executor thread
+        self._in_flight = 0  # submitted and not finished (includes _queued)
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=max_size, thread_name_prefix="db")
+        self._reset_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-reset")
+        DB_POOL_MAX.set(max_size)
+
+    # -- lifecycle ------------------------------------------------------------
+
+    def close(self):
+        """Close idle connections and refuse new checkouts. In-use connections
+        are closed when they are returned."""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._size -= len(idle)
+            self._publish()
+            self._cond.notify_all()
+        for slot in idle:
+            self._discard(slot, "shutdown")
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._reset_executor.shutdown(wait=False)
+
+    # -- checkout / checkin ---------------------------------------------------
+
+    def getconn(self, timeout: float = None, submitted: float = None) -> _Slot:
+        """Check a connection out. `submitted` is when the caller asked for
+        it (run() / hold()), if earlier than now; acquire time counts from
+        there."""
+        start = time.monotonic()
+        deadline = start + (self.acquire_timeout if timeout is None else timeout)
+        slot = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout("connection pool is closed")
+                while self._idle:
+                    # LIFO: reuse the most recently returned (warmest) connection.
+                    candidate = self._idle.pop()
+                    if candidate.conn.closed or self._expired(candidate):
+                        self._size -= 1
+                        self._publish()
+                        reason = "broken" if candidate.conn.closed else "expired"
+                        self._cond.release()
+                        try:
+                            self._discard(candidate, reason)
+                        finally:
+                            self._cond.acquire()
+                        continue
+                    slot = candidate
+                    break
+                if slot is not None:
+                    break
+                if self._size < self.max_size:
+                    self._size += 1  # reserve; connect outside the lock
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    DB_POOL_ACQUIRE_TIMEOUTS.inc()
+                    raise PoolTimeout(
+                        f"timed out after {self.acquire_timeout}s waiting for a database connection"
+                    )
+                self._waiters += 1
+                self._publish()
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiters -= 1
+                    self._publish()
+            if slot is not None:
+                self._in_use += 1
+                self._publish()
+
+        if slot is None:
+            try:
+                slot = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._publish()
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._in_use += 1
+                self._publish()
+
+        DB_POOL_ACQUIRE_SECONDS.observe(time.monotonic() - (start if submitted is None else submitted))
+        return slot
+
+    def putconn(self, slot: _Slot, discard: bool = False):
+        conn = slot.conn
+        reason = None
+        if conn.closed:
+            reason = "broken"
+        elif discard:
+            reason = "broken"
+        elif self._expired(slot):
+            reason = "expired"
+        elif self._needs_reset(conn):
+            # Someone left a transaction open (or it errored). Roll back so the
+            # next borrower starts clean; if that fails the connection is dead.
+            try:
+                conn.rollback()
+                conn.autocommit = True
+            except Exception:
+                reason = "broken"
+
+        with self._cond:
+            self._in_use -= 1
+            if reason is None and self._closed:
+                reason = "shutdown"
+            if reason is None:
+                self._idle.append(slot)
+            else:
+                self._size -= 1
+            self._publish()
+            self._cond.notify()
+        if reason is not None:
+            self._discard(slot, reason)
+
+    @contextmanager
+    def connection(self, timeout: float = None, submitted: float = None):
+        """Borrow a connection for the duration of a `with` block."""
+        slot = self.getconn(timeout, submitted)
+        try:
+            yield slot.conn
+        except psycopg2.OperationalError:
+            # Network / server errors usually leave the connection unusable
+            # even if psycopg2 hasn't flagged it closed yet.
+            self.putconn(slot, discard=True)
+            raise
+        except BaseException:
+            self.putconn(slot)
+            raise
+        else:
+            self.putconn(slot)
+
+    async def run(self, fn, *args):
+        """Run `fn(conn, *args)` with a pooled connection on the DB executor.
+
+        The caller's contextvars (active OTEL span, etc.) are copied into the
+        worker thread so instrumented queries still nest under the request
+        span. Time spent queued for a thread counts against acquire_timeout,
+        so a backed-up executor surfaces as PoolTimeout, not unbounded latency.
+        """
+        submitted = time.monotonic()
+        ctx = contextvars.copy_context()
+        future = self._submit(functools.partial(ctx.run, self._run_sync, fn, submitted, args))
+        return await asyncio.wrap_future(future)
+
+    def _run_sync(self, fn, submitted, args):
+        with self.connection(timeout=self._remaining(submitted), submitted=submitted) as conn:
+            return _timed(fn, submitted, conn, args)
+
+    def _submit(self, call):
+        """Submit `call` (which checks a connection out) to the DB executor,
+        counted as queued until a thread picks it up."""
+        with self._cond:
+            self._queued += 1
+            self._in_flight += 1
+            self._publish()
+        try:
+            future = self._executor.submit(self._started, call)
+        except BaseException:
+            with self._cond:
+                self._queued -= 1
+                self._in_flight -= 1
+                self._publish()
+            raise
+        future.add_done_callback(self._finished)
+        return future
+
+    def _started(self, call):
+        with self._cond:
+            self._queued -= 1
+            self._publish()
+        return call()
+
+    def _finished(self, future):
+        with self._cond:
+            if future.cancelled():
+                self._queued -= 1  # never reached a thread
+            self._in_flight -= 1
+            self._publish()
+
+    @asynccontextmanager
+    async def hold(self):
+        """Borrow one connection for the duration of an `async with` block.
+
+        Yields a HeldConnection whose `await held.run(fn, *args)` runs
+        `fn(conn, *args)` on the DB executor like run(), but always on the
+        same connection — for a server-side cursor read in batches between
+        awaits. The connection is out of the pool for the whole block.
+        """
+        submitted = time.monotonic()
+        future = self._submit(lambda: self.getconn(timeout=self._remaining(submitted), submitted=submitted))
+        try:
+            slot = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # The checkout may still succeed after we stopped waiting for it.
+            future.add_done_callback(self._release_abandoned)
+            raise
+        held = HeldConnection(self, slot)
+        try:
+            yield held
+        finally:
+            held.release()
+
+    def _release_abandoned(self, future):
+        if not future.cancelled() and future.exception() is None:
+            self.putconn(future.result())
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": self._size,
+                "max": self.max_size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                # Callers without a connection yet, wherever they wait.
+                "waiters": self._queued + self._waiters,
+                "queued": self._queued,
+                "in_flight": self._in_flight,
+            }
+
+    # -- internals ------------------------------------------------------------
+
+    def _connect(self) -> _Slot:
+        conn = psycopg2.connect(self.dsn, connection_factory=Connection)
+        conn.autocommit = True
+        DB_POOL_CONNECTIONS_OPENED.inc()
+        return _Slot(conn)
+
+    def _remaining(self, submitted: float) -> float:
+        return max(self.acquire_timeout - (time.monotonic() - submitted), 0)
+
+    @staticmethod
+    def _needs_reset(conn) -> bool:
+        """putconn() will have to ROLLBACK `conn` (a round trip)."""
+        return conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE or not conn.autocommit
+
+    def _expired(self, slot: _Slot) -> bool:
+        return self.max_lifetime > 0 and time.monotonic() - slot.created_at > self.max_lifetime
+
+    @staticmethod
+    def _discard(slot: _Slot, reason: str):
+        try:
+            slot.conn.close()
+        except Exception:
+            pass
+        DB_POOL_CONNECTIONS_CLOSED.labels(reason=reason).inc()
+
+    def _publish(self):
+        # Called with the lock held, so the three gauges are mutually consistent.
+        DB_POOL_IN_USE.set(self._in_use)
+        DB_POOL_IDLE.set(len(self._idle))
+        DB_POOL_WAITERS.set(self._queued + self._waiters)
+
+
+def _timed(fn, submitted, conn, args):
+    statement = getattr(fn, "__name__", "other")
+    start = time.monotonic()
+    DB_QUERY_WAIT_SECONDS.labels(statement=statement).observe(start - submitted)
+    try:
+        return fn(conn, *args)
+    finally:
+        DB_QUERY_SECONDS.labels(statement=statement).observe(time.monotonic() - start)
+
+
+class HeldConnection:
+    """A connection checked out across awaits; see ConnectionPool.hold()."""
+
+    def __init__(self, pool: ConnectionPool, slot: _Slot):
+        self._pool = pool
+        self._slot = slot
+        self._last = None     # future of the most recent run()
+        self._broken = False
+
+    async def run(self, fn, *args):
+        ctx = contextvars.copy_context()
+        self._last = self._pool._executor.submit(ctx.run, self._call, fn, time.monotonic(), args)
+        return await asyncio.wrap_future(self._last)
+
+    def _call(self, fn, submitted, args):
+        try:
+            return _timed(fn, submitted, self._slot.conn, args)
+        except psycopg2.OperationalError:
+            self._broken = True
+            raise
+
+    def release(self):
+        # Never awaits, so it also works while the owner is being cancelled
+        # (e.g. the client went away mid-stream). If a call is still running
+        # on the connection, check in after it finishes, not concurrently
+        # (from the thread that ran it). Never through the DB executor: its
+        # threads may all be blocked in getconn() waiting for this
+        # connection.
+        def checkin(_=None):
+            self._pool.putconn(self._slot, discard=self._broken)
+
+        if self._last is not None and not self._last.done():
+            self._last.add_done_callback(checkin)
+            return
+        conn = self._slot.conn
+        if self._broken or conn.closed or not self._pool._needs_reset(conn):
+            checkin()  # no network round trip: fine on the event loop
+            return
+        try:
+            self._pool._reset_executor.submit(checkin)
+        except RuntimeError:
+            checkin()  # executor already shut down
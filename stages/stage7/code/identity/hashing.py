@@ -0,0 +1,310 @@
+# bcrypt hashing for the identity service, off the event loop.
+#
+# A bcrypt hash or verify at cost 12 is ~250ms of pure CPU. Run inline in an
+# `async def` handler it blocks every other request on the worker —
+# including /healthz/live, which is how a login burst used to get healthy
+# pods restarted by the kubelet. HashPool runs the work in a
+# ProcessPoolExecutor instead:
+#
+#   - size-limited: `workers` processes (default: one per core), so hashing
+#     scales across cores without the GIL and can't starve the event loop.
+#   - bounded queue: at most `workers + queue_size` hash jobs are in flight;
+#     beyond that callers get HashQueueFull immediately (503 in main.py).
+#   - deadline: a job that hasn't *started* within `deadline` seconds of
+#     being submitted is dropped by the worker without hashing, and the
+#     caller gets HashDeadlineExceeded. Once a client has likely given up,
+#     burning 250ms of CPU for it only makes the backlog worse.
+#   - self-healing: a worker process that dies (OOM kill under the pod's
+#     memory limit, a crash in the bcrypt backend) breaks a
+#     ProcessPoolExecutor for good. The jobs it took down fail with
+#     HashPoolBroken, the pool is replaced by a fresh one and re-warmed in
+#     the background, and `broken` stays set — the pod reports unready —
+#     until the new workers have hashed once.
+#
+# Cost factor: hashes are produced at `rounds` (BCRYPT_ROUNDS, default 12).
+# calibrate() can instead measure this machine and pick the highest cost
+# whose hash time fits a latency budget — at startup (BCRYPT_CALIBRATE) or
+# from the CLI:
+#
+#   python hashing.py calibrate --budget-ms 250
+#
+# needs_update() flags stored hashes that are cheaper than `rounds`; main.py
+# rehashes those in the background after a successful login. A hash above
+# the current cost is left alone — a stored cost is never lowered, so a pod
+# calibrated lower than the one that wrote the hash (smaller node, tighter
+# CPU limit) can't downgrade it, and pods calibrated differently can't
+# rewrite the same account back and forth.
+#
+# Worker processes use the "spawn" start method: forking a process that
+# already runs the DB executor and OTEL exporter threads can copy a held
+# lock into the child. Jobs only reference this module, but spawn also
+# re-imports the parent's __main__ script in every worker. Under server.py
+# (the container's entry point) that is server.py, which imports uvicorn
+# and nothing from the service. Under `python main.py` it is main.py,
+# so each worker builds its own DB pool, OTEL exporter and log thread.
+# That is fine for a local run and not for anything else.
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from passlib.context import CryptContext
+
+from metrics import (
+    BCRYPT_ROUNDS,
+    HASH_DURATION_SECONDS,
+    HASH_POOL_RESTARTS,
+    HASH_QUEUE_DEPTH,
+    HASH_QUEUE_WAIT_SECONDS,
+    HASH_REJECTED,
+    mark_process_dead,
+)
+
+DEFAULT_ROUNDS = 12
+
+
+def make_context(rounds: int) -> CryptContext:
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__default_rounds=rounds,
+        bcrypt__min_rounds=rounds,
+    )
+
+
+class HashUnavailable(Exception):
+    """Password hashing is saturated; the request should be retried later."""
+
+
+class HashQueueFull(HashUnavailable):
+    pass
+
+
+class HashDeadlineExceeded(HashUnavailable):
+    pass
+
+
+class HashPoolBroken(HashUnavailable):
+    pass
+
+
+# -----------------------------------------------------------------------------
+# Worker-process side
+# -----------------------------------------------------------------------------
+_worker_contexts = {}  # rounds -> CryptContext
+
+
+def _init_worker():
+    # Workers die with SIGTERM and leave Ctrl-C to the parent, whatever
+    # handlers the re-imported __main__ module may have installed.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Importing this module registered the service's gauges under our pid
+    # in PROMETHEUS_MULTIPROC_DIR; workers never set them, so don't export
+    # a zero series per worker.
+    mark_process_dead(os.getpid())
+
+
+def _ping():
+    return True
+
+
+def _run_job(op, rounds, args, deadline):
+    # time.monotonic() is CLOCK_MONOTONIC on Linux — one clock for the whole
+    # machine — so the parent's submit timestamp and ours are comparable.
+    # A None result (never a valid hash/verify outcome) means "expired".
+    started = time.monotonic()
+    if started > deadline:
+        return None, started, 0.0
+    context = _worker_contexts.get(rounds)
+    if context is None:
+        context = _worker_contexts[rounds] = make_context(rounds)
+    result = getattr(context, op)(*args)
+    return result, started, time.monotonic() - started
+
+
+def calibrate(budget: float, min_rounds: int, max_rounds: int, samples: int = 3):
+    """Return (rounds, {rounds: seconds}) for the highest cost in
+    [min_rounds, max_rounds] whose median hash time is within `budget`.
+
+    Each extra round doubles the cost, so we walk upwards from min_rounds and
+    stop at the first cost over budget — total calibration time stays around
+    twice the budget. min_rounds is returned even if it is over budget:
+    it is a security floor, not a suggestion.
+    """
+    timings = {}
+    chosen = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        hasher = make_context(rounds)
+        runs = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            hasher.hash("calibration-probe")
+            runs.append(time.perf_counter() - start)
+        timings[rounds] = sorted(runs)[len(runs) // 2]
+        if timings[rounds] > budget:
+            break
+        chosen = rounds
+    return chosen, timings
+
+
+# -----------------------------------------------------------------------------
+# Event-loop side
+# -----------------------------------------------------------------------------
+class HashPool:
+    def __init__(self, workers: int, queue_size: int, deadline: float, rounds: int = DEFAULT_ROUNDS):
+        self.workers = max(workers, 1)
+        self.max_pending = self.workers + max(queue_size, 0)
+        self.deadline = deadline
+        self._pending = 0
+        self._executor = self._new_executor()
+        self._recovery = None
+        self.broken = False
+        self.set_rounds(rounds)
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+
+    def set_rounds(self, rounds: int):
+        """Change the cost used for new hashes (and by needs_update)."""
+        self.rounds = rounds
+        self._context = make_context(rounds)
+        BCRYPT_ROUNDS.set(rounds)
+
+    def needs_update(self, password_hash: str) -> bool:
+        """True if a stored hash is cheaper than the current cost. Only
+        parses the hash header — cheap enough for the event loop."""
+        try:
+            return self._context.needs_update(password_hash)
+        except ValueError:
+            return False
+
+    @property
+    def idle(self) -> bool:
+        """At least one worker process has nothing to do."""
+        return self._pending < self.workers
+
+    async def calibrate(self, budget: float, min_rounds: int, max_rounds: int):
+        """Run calibrate() in a worker process and adopt its result."""
+        loop = asyncio.get_running_loop()
+        rounds, timings = await loop.run_in_executor(
+            self._executor, calibrate, budget, min_rounds, max_rounds
+        )
+        self.set_rounds(rounds)
+        return rounds, timings
+
+    @property
+    def pending(self) -> int:
+        """Jobs submitted and not yet finished (running + queued)."""
+        return self._pending
+
+    async def start(self):
+        """Spawn every worker process now instead of on the first logins.
+
+        Spawning a worker (fresh interpreter + passlib import) takes a second
+        or more; paid lazily it would count as queue wait and could push the
+        first requests after a rollout past the deadline.
+        """
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(self._executor, _ping) for _ in range(self.workers)
+        ))
+
+    async def warm_up(self):
+        """Hash once in every worker at the current cost: loads the bcrypt
+        backend and builds the worker's CryptContext ahead of the first
+        login. Call after calibrate()."""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(self._executor, _run_job, "hash", self.rounds, ("warm-up",), float("inf"))
+            for _ in range(self.workers)
+        ))
+
+    async def hash(self, password: str) -> str:
+        return await self._submit("hash", password)
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        return await self._submit("verify", password, password_hash)
+
+    async def _submit(self, op, *args):
+        # _pending is only touched from the event loop thread, so no lock.
+        if self._pending >= self.max_pending:
+            HASH_REJECTED.labels(reason="queue_full").inc()
+            raise HashQueueFull(f"password hashing queue is full ({self.max_pending} jobs)")
+        self._pending += 1
+        HASH_QUEUE_DEPTH.set(self._pending)
+        submitted = time.monotonic()
+        executor = self._executor
+        try:
+            loop = asyncio.get_running_loop()
+            result, started, duration = await loop.run_in_executor(
+                executor, _run_job, op, self.rounds, args, submitted + self.deadline
+            )
+        except BrokenProcessPool:
+            HASH_REJECTED.labels(reason="pool_broken").inc()
+            self._replace(executor)
+            raise HashPoolBroken(f"password {op} failed: a hash worker process died") from None
+        finally:
+            self._pending -= 1
+            HASH_QUEUE_DEPTH.set(self._pending)
+        HASH_QUEUE_WAIT_SECONDS.labels(op=op).observe(max(started - submitted, 0.0))
+        if result is None:
+            HASH_REJECTED.labels(reason="deadline").inc()
+            raise HashDeadlineExceeded(f"password {op} did not start within {self.deadline}s")
+        HASH_DURATION_SECONDS.labels(op=op).observe(duration)
+        return result
+
+    def _replace(self, executor):
+        # Every job on the broken executor fails at once; the first to get
+        # here swaps in the new one, the rest find it already replaced.
+        if executor is not self._executor:
+            return
+        self.broken = True
+        HASH_POOL_RESTARTS.inc()
+        executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._new_executor()
+        self._recovery = asyncio.create_task(self._recover(self._executor))
+
+    async def _recover(self, executor):
+        try:
+            await self.start()
+            await self.warm_up()
+        except BrokenProcessPool:
+            # A worker died again while warming up; pause so a worker that
+            # can't start at all doesn't turn this into a spawn loop.
+            await asyncio.sleep(1.0)
+            self._replace(executor)
+            return
+        except Exception:
+            pass  # not a dead worker: the new pool is usable as it is
+        if executor is self._executor:
+            self.broken = False
+
+    def close(self):
+        if self._recovery is not None:
+            self._recovery.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="bcrypt cost tools for the identity service")
+    sub = parser.add_subparsers(dest="command", required=True)
+    cal = sub.add_parser("calibrate", help="measure this machine and print the recommended BCRYPT_ROUNDS")
+    cal.add_argument("--budget-ms", type=float, default=250.0)
+    cal.add_argument("--min-rounds", type=int, default=DEFAULT_ROUNDS)
+    cal.add_argument("--max-rounds", type=int, default=15)
+    opts = parser.parse_args()
+
+    chosen, measured = calibrate(opts.budget_ms / 1000.0, opts.min_rounds, opts.max_rounds)
+    for cost, seconds in measured.items():
+        marker = "  <- BCRYPT_ROUNDS" if cost == chosen else ""
+        print(f"rounds={cost:2d}  {seconds * 1000:8.1f} ms{marker}")
+    print(f"BCRYPT_ROUNDS={chosen}")
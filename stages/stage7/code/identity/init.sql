@@ -11,11 +11,28 @@ CREATE TABLE IF NOT EXISTS users (
     loyalty_tier     VARCHAR(20) DEFAULT 'STANDARD',
     role             VARCHAR(20) DEFAULT 'PASSENGER',
     is_active        BOOLEAN DEFAULT TRUE,
-    created_at       TIMESTAMP DEFAULT NOW(),
+    created_at       TIMESTAMP NOT NULL DEFAULT NOW(),
     updated_at       TIMESTAMP DEFAULT NOW()
 );
 
--- Seed users (passwords are bcrypt hashes of the plain text values below)
+-- GET /api/admin/users pages through users newest-first on (created_at, id)
+-- (keyset pagination). The role / tier variants keep filtered listings
+-- (all admins, all PLATINUM members) on an index too.
+CREATE INDEX IF NOT EXISTS users_created_at_id_idx ON users (created_at, id);
+CREATE INDEX IF NOT EXISTS users_role_created_at_id_idx ON users (role, created_at, id);
+CREATE INDEX IF NOT EXISTS users_tier_created_at_id_idx ON users (loyalty_tier, created_at, id);
+
+-- Profile If-None-Match checks read only (updated_at, is_active) by id;
+-- covering both makes that an index-only scan.
+CREATE INDEX IF NOT EXISTS users_id_version_idx ON users (id) INCLUDE (updated_at, is_active);
+
+-- Later schema changes are migrations (migrations/, see migrations.py),
+-- applied by the service at startup; this script only runs on an empty
+-- data dir.
+
+-- Seed users (passwords are bcrypt hashes of the plain text values below).
+-- The seeds are cost 12; the service upgrades them on first login if its
+-- configured/calibrated cost is higher, and never lowers a stored cost.
 -- admin123  →  $2b$12$kflBUCuS6Lagf1HRHUX8c.R68u93qgg7CRQ9exm8/x5IhA3s9eT3i
 -- pass123    →  $2b$12$YK9qpQ28hFUSICvWuiLm5OLjiibWe.zXXDsLiHl7YNrT6adahZ8Gu
 
@@ -0,0 +1,157 @@
+# Structured JSON logging for the identity service, off the request path.
+#
+# log_json used to build the line and print() it on the event loop. stdout
+# is a pipe to the container runtime; when the log shipper falls behind,
+# the pipe fills and that print() blocks — and with it every request on the
+# worker. JsonLogger makes logging an append to a queue:
+#
+#   - the caller only captures what must be captured in its own context
+#     (wall-clock time, trace/span/request IDs, the fields) and enqueues a
+#     tuple. Timestamp formatting, json.dumps and the write happen on a
+#     background thread, in batches of up to `batch_size` lines per
+#     write() + flush().
+#   - bounded queue: at most `queue_size` records wait. When it is full,
+#     policy "drop" (default) discards the new record and counts it in
+#     log_records_dropped_total{reason="queue_full"}; policy "block" waits
+#     for room, trading request latency for never losing a line.
+#   - cached timestamps: the "YYYY-MM-DDTHH:MM:SS" part is formatted once
+#     per second, only the microseconds are added per line.
+#   - sampling: `sample_rates` maps a level to the fraction of its records
+#     kept (e.g. {"INFO": 0.1} on a login-heavy pod). Sampled-out records
+#     are dropped before any work is done. Levels not listed are all kept.
+#
+# The queue is a queue.SimpleQueue: unlike queue.Queue its put() is
+# reentrant, so log_json is safe to call from the SIGTERM handler even if
+# the signal lands while the main thread is itself enqueueing.
+#
+# close() (called from the lifespan shutdown) and an atexit hook flush what
+# is still queued, so the last lines before a SIGTERM aren't lost. Anything
+# logged after close() is written synchronously.
+import atexit
+import json
+import queue
+import random
+import sys
+import threading
+import time
+
+from metrics import LOG_QUEUE_DEPTH, LOG_RECORDS_DROPPED
+
+_STOP = object()
+
+
+def parse_sample_rates(spec: str) -> dict:
+    """Parse "INFO=0.1,DEBUG=0" into {"INFO": 0.1, "DEBUG": 0.0}."""
+    rates = {}
+    for item in spec.split(","):
+        if item.strip():
+            level, _, rate = item.partition("=")
+            rates[level.strip().upper()] = float(rate)
+    return rates
+
+
+class JsonLogger:
+    def __init__(self, stream=None, queue_size: int = 10000, policy: str = "drop",
+                 batch_size: int = 256, sample_rates: dict = None):
+        if policy not in ("drop", "block"):
+            raise ValueError(f"unknown log queue policy: {policy}")
+        self.stream = stream or sys.stdout
+        self.policy = policy
+        self.batch_size = batch_size
+        self.sample_rates = sample_rates or {}
+        self.queue_size = queue_size
+        self._queue = queue.SimpleQueue()
+        # "block" policy only: one permit per free queue slot.
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._closed = False
+        self._write_lock = threading.Lock()
+        self._ts_second = None
+        self._ts_prefix = ""
+        self._thread = threading.Thread(target=self._run, name="jsonlog", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def enabled(self, level: str) -> bool:
+        """False if this record should be sampled out. Check before doing
+        any work to build it."""
+        rate = self.sample_rates.get(level)
+        if rate is None or rate >= 1.0:
+            return True
+        if rate > 0.0 and random.random() < rate:
+            return True
+        LOG_RECORDS_DROPPED.labels(reason="sampled").inc()
+        return False
+
+    def log(self, level: str, service: str, message: str, trace_id: str = "",
+            span_id: str = "", request_id: str = "", fields: dict = None):
+        record = (time.time(), level, service, trace_id, span_id, message, request_id, fields)
+        if self._closed:
+            self._write([self._format(record)])
+            return
+        if self.policy == "block":
+            self._slots.acquire()
+        elif self._queue.qsize() >= self.queue_size:
+            LOG_RECORDS_DROPPED.labels(reason="queue_full").inc()
+            return
+        self._queue.put(record)
+
+    def close(self, timeout: float = 2.0):
+        """Write out everything queued so far and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    # -- writer thread ----------------------------------------------------------
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            LOG_QUEUE_DEPTH.set(self._queue.qsize())
+            stop = any(record is _STOP for record in batch)
+            records = [record for record in batch if record is not _STOP]
+            if self.policy == "block":
+                for _ in records:
+                    self._slots.release()
+            self._write([self._format(record) for record in records])
+            if stop:
+                return
+
+    def _write(self, lines):
+        if not lines:
+            return
+        with self._write_lock:
+            try:
+                self.stream.write("\n".join(lines) + "\n")
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass  # stdout closed / broken pipe: nowhere left to log to
+
+    def _format(self, record) -> str:
+        ts, level, service, trace_id, span_id, message, request_id, fields = record
+        entry = {
+            "timestamp": self._timestamp(ts),
+            "level": level,
+            "service": service,
+            "trace_id": trace_id,
+            "span_id": span_id,
+            "message": message,
+        }
+        if request_id:
+            entry["request_id"] = request_id
+        if fields:
+            entry.update(fields)
+        return json.dumps(entry, default=str)
+
+    def _timestamp(self, ts: float) -> str:
+        second = int(ts)
+        if second != self._ts_second:
+            self._ts_second = second
+            self._ts_prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second))
+        return f"{self._ts_prefix}.{int((ts - second) * 1e6):06d}Z"
@@ -0,0 +1,83 @@
+# Micro-batching for user-by-id reads.
+#
+# At peak booking resolves dozens of users at once, one
+# GET /api/users/{id} each, and every profile-cache miss used to be its
+# own `SELECT ... WHERE id = $1` — a connection checkout, an executor hop
+# and a round trip apiece. BatchLoader collects the lookups that arrive
+# within `window` seconds of the first one and sends them as one
+# `fetch_many(keys)` (queries.profiles_by_ids: `id = ANY($1)`, a single
+# primary-key index scan), then hands every waiting request its own row:
+#
+#   - a batch is sent when the window closes or as soon as it holds
+#     `max_batch` distinct keys, whichever comes first;
+#   - the same key requested twice in one batch is fetched once;
+#   - if the query fails, every request in the batch gets the exception;
+#   - a request cancelled while waiting just drops out; the batch still
+#     runs for the others.
+#
+# The window is the latency a lone request pays for the batching, so keep
+# it around a query's own duration (a millisecond or two). Event-loop only,
+# like the caches. user_loader_batch_size and user_loader_wait_seconds on
+# /metrics show how well lookups coalesce.
+import asyncio
+import time
+
+from metrics import USER_LOADER_BATCH_SIZE, USER_LOADER_WAIT_SECONDS
+
+
+class BatchLoader:
+    def __init__(self, fetch_many, window: float = 0.002, max_batch: int = 100):
+        self.fetch_many = fetch_many  # async fetch_many(keys) -> {key: row}
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}  # key -> [(future, enqueued_at), ...]
+        self._timer = None
+        self._tasks = set()
+
+    async def load(self, key):
+        """The row for `key`, or None if fetch_many didn't return one."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(key, []).append((future, time.monotonic()))
+        if len(self._pending) >= self.max_batch:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._dispatch)
+        return await future
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        now = time.monotonic()
+        USER_LOADER_BATCH_SIZE.observe(len(batch))
+        for waiters in batch.values():
+            for _, enqueued_at in waiters:
+                USER_LOADER_WAIT_SECONDS.observe(now - enqueued_at)
+        # Strong reference: the loop only keeps a weak one to running tasks.
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        try:
+            rows = await self.fetch_many(list(batch))
+        except asyncio.CancelledError:
+            for waiters in batch.values():
+                for future, _ in waiters:
+                    future.cancel()
+            raise
+        except Exception as e:
+            for waiters in batch.values():
+                for future, _ in waiters:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for key, waiters in batch.items():
+            row = rows.get(key)
+            for future, _ in waiters:
+                if not future.done():
+                    future.set_result(row)
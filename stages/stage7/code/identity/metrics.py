@@ -0,0 +1,280 @@
+# Prometheus metrics owned by the identity service.
+#
+# Everything here registers against prometheus_client's default REGISTRY,
+# so `/metrics` (generate_latest(SCRAPE_REGISTRY)) picks it up with no
+# extra wiring. Keep label sets bounded — a label value must never come
+# from user input (emails, user IDs, raw paths).
+#
+# Multi-worker mode: with several worker processes behind one port, each
+# process has its own registry and a scrape would see whichever worker
+# answered. When PROMETHEUS_MULTIPROC_DIR is set (it must be in the
+# environment before prometheus_client is imported, i.e. set by the
+# launcher or the pod), every metric is backed by an mmap file in that
+# directory and SCRAPE_REGISTRY is a MultiProcessCollector that sums them:
+#
+#   - counters and histograms add up across workers, dead ones included,
+#     so rates don't dip when a worker is replaced.
+#   - every Gauge declares a multiprocess_mode: "livesum" for pool/queue/
+#     cache sizes (pod totals), "livemax" for settings, "liveall" (one
+#     series per pid) for the profile cache hit ratio, which doesn't add.
+#   - a worker calls mark_process_dead(pid) as it exits (and the launcher
+#     for workers that died without cleaning up), dropping its live gauges.
+#   - set_function() gauges only exist in the process that set them; code
+#     that uses one must set() the value instead when MULTIPROCESS is true.
+#   - the directory must start empty on every pod/container start; the
+#     launcher wipes it before forking workers.
+#
+# The process_* / python_* default collectors describe only the process
+# being scraped, so they aren't exported in this mode.
+import os
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR", "")
+MULTIPROCESS = bool(MULTIPROC_DIR)
+
+if MULTIPROCESS:
+    SCRAPE_REGISTRY = CollectorRegistry()
+    multiprocess.MultiProcessCollector(SCRAPE_REGISTRY, path=MULTIPROC_DIR)
+else:
+    SCRAPE_REGISTRY = REGISTRY
+
+
+def mark_process_dead(pid: int):
+    """Drop the live gauges of worker `pid` (no-op in single-process mode)."""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
+
+
+# -----------------------------------------------------------------------------
+# Postgres connection pool (db.ConnectionPool)
+# -----------------------------------------------------------------------------
+_DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+DB_POOL_MAX = Gauge(
+    "db_pool_connections_max",
+    "Configured maximum number of pooled Postgres connections.",
+    multiprocess_mode="livesum",
+)
+DB_POOL_IN_USE = Gauge(
+    "db_pool_connections_in_use",
+    "Pooled Postgres connections currently checked out by a request.",
+    multiprocess_mode="livesum",
+)
+DB_POOL_IDLE = Gauge(
+    "db_pool_connections_idle",
+    "Open Postgres connections sitting idle in the pool.",
+    multiprocess_mode="livesum",
+)
+DB_POOL_WAITERS = Gauge(
+    "db_pool_waiters",
+    "Callers waiting for a pooled connection: queued for a DB executor thread or blocked in checkout.",
+    multiprocess_mode="livesum",
+)
+DB_POOL_ACQUIRE_SECONDS = Histogram(
+    "db_pool_acquire_seconds",
+    "Time from a run()/hold() call to its connection being checked out (executor queue + checkout).",
+    buckets=_DB_BUCKETS,
+)
+DB_POOL_ACQUIRE_TIMEOUTS = Counter(
+    "db_pool_acquire_timeouts_total",
+    "Checkouts that gave up after DB_POOL_ACQUIRE_TIMEOUT.",
+)
+DB_POOL_CONNECTIONS_OPENED = Counter(
+    "db_pool_connections_opened_total",
+    "Physical Postgres connections opened by the pool.",
+)
+DB_POOL_CONNECTIONS_CLOSED = Counter(
+    "db_pool_connections_closed_total",
+    "Physical Postgres connections closed by the pool.",
+    ["reason"],  # expired | broken | shutdown
+)
+# `statement` is the name of the queries.py function run on the connection,
+# so the label set is fixed by the code.
+DB_QUERY_WAIT_SECONDS = Histogram(
+    "db_query_wait_seconds",
+    "Time from pool.run() to the statement starting: DB thread queue plus connection checkout.",
+    ["statement"],
+    buckets=_DB_BUCKETS,
+)
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds",
+    "Time spent running a statement function on its connection (round trips included).",
+    ["statement"],
+    buckets=_DB_BUCKETS,
+)
+
+# -----------------------------------------------------------------------------
+# bcrypt process pool (hashing.HashPool)
+# -----------------------------------------------------------------------------
+_HASH_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0)
+
+HASH_QUEUE_WAIT_SECONDS = Histogram(
+    "password_hash_queue_wait_seconds",
+    "Time a password hash/verify job waited for a free worker process.",
+    ["op"],  # hash | verify
+    buckets=_HASH_BUCKETS,
+)
+HASH_DURATION_SECONDS = Histogram(
+    "password_hash_duration_seconds",
+    "CPU time of a single bcrypt hash/verify inside a worker process.",
+    ["op"],
+    buckets=_HASH_BUCKETS,
+)
+HASH_QUEUE_DEPTH = Gauge(
+    "password_hash_queue_depth",
+    "Password hash/verify jobs submitted and not yet finished.",
+    multiprocess_mode="livesum",
+)
+HASH_REJECTED = Counter(
+    "password_hash_rejected_total",
+    "Password hash/verify jobs rejected before running.",
+    ["reason"],  # queue_full | deadline | pool_broken
+)
+HASH_POOL_RESTARTS = Counter(
+    "password_hash_pool_restarts_total",
+    "Hash worker pools rebuilt after a worker process died (OOM kill, crash).",
+)
+BCRYPT_ROUNDS = Gauge(
+    "password_hash_bcrypt_rounds",
+    "bcrypt cost factor used for new hashes (configured or calibrated).",
+    multiprocess_mode="livemax",
+)
+PASSWORD_REHASH = Counter(
+    "password_rehash_total",
+    "Background rehashes of stale password hashes after a successful login.",
+    ["result"],  # updated | skipped | failed
+)
+
+# -----------------------------------------------------------------------------
+# JWT signing / verification (tokens.SigningKeys) and verified-JWT cache
+# (tokens.TokenCache)
+# -----------------------------------------------------------------------------
+_FAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
+JWT_SECONDS = Histogram(
+    "jwt_duration_seconds",
+    "Time to sign (encode) or verify (decode) a JWT. Cache hits skip decode entirely.",
+    ["op"],  # encode | decode
+    buckets=_FAST_BUCKETS,
+)
+JWT_CACHE_HITS = Counter(
+    "jwt_cache_hits_total",
+    "Bearer tokens served from the verified-token cache (no signature check).",
+)
+JWT_CACHE_MISSES = Counter(
+    "jwt_cache_misses_total",
+    "Bearer tokens that had to be fully verified with jwt.decode.",
+)
+JWT_CACHE_EVICTIONS = Counter(
+    "jwt_cache_evictions_total",
+    "Entries dropped from the verified-token cache.",
+    ["reason"],  # expired | lru
+)
+JWT_CACHE_SIZE = Gauge(
+    "jwt_cache_entries",
+    "Verified tokens currently cached.",
+    multiprocess_mode="livesum",
+)
+
+# -----------------------------------------------------------------------------
+# User profile cache (cache.ProfileCache)
+# -----------------------------------------------------------------------------
+PROFILE_CACHE_HITS = Counter(
+    "profile_cache_hits_total",
+    "User profile reads served from the in-process cache.",
+)
+PROFILE_CACHE_MISSES = Counter(
+    "profile_cache_misses_total",
+    "User profile reads that had to query Postgres.",
+)
+PROFILE_CACHE_EVICTIONS = Counter(
+    "profile_cache_evictions_total",
+    "Entries dropped from the profile cache.",
+    ["reason"],  # expired | lru | invalidated
+)
+PROFILE_CACHE_SIZE = Gauge(
+    "profile_cache_entries",
+    "User profiles currently cached.",
+    multiprocess_mode="livesum",
+)
+PROFILE_CACHE_HIT_RATIO = Gauge(
+    "profile_cache_hit_ratio",
+    "Fraction of cacheable profile reads served from the cache since start.",
+    multiprocess_mode="liveall",
+)
+
+# -----------------------------------------------------------------------------
+# Shared profile cache (cache.SharedProfileCache, Redis)
+# -----------------------------------------------------------------------------
+# Same names and `service` label as search's cache counters, so one Grafana
+# hit-ratio panel covers both services.
+CACHE_HITS = Counter(
+    "cache_hits_total",
+    "Profile reads served from cache (in-process or Redis).",
+    ["service"],
+)
+CACHE_MISSES = Counter(
+    "cache_misses_total",
+    "Profile reads that had to query Postgres.",
+    ["service"],
+)
+SHARED_CACHE_ERRORS = Counter(
+    "shared_cache_errors_total",
+    "Redis profile cache operations that failed (a failed read is treated as a miss).",
+    ["op"],  # get | set | delete | publish | subscribe
+)
+
+# -----------------------------------------------------------------------------
+# Structured logging (jsonlog.JsonLogger)
+# -----------------------------------------------------------------------------
+LOG_RECORDS_DROPPED = Counter(
+    "log_records_dropped_total",
+    "Log records not written.",
+    ["reason"],  # sampled | queue_full
+)
+LOG_QUEUE_DEPTH = Gauge(
+    "log_queue_depth",
+    "Log records waiting for the writer thread (sampled after each batch).",
+    multiprocess_mode="livesum",
+)
+
+# -----------------------------------------------------------------------------
+# HTTP requests (middleware.InstrumentedRoute, middleware.TimedJSONResponse)
+# -----------------------------------------------------------------------------
+# `route` is the route template ("/api/users/{user_id}"), never the raw path.
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Requests currently being handled, including streaming the response body.",
+    ["route"],
+    multiprocess_mode="livesum",
+)
+RESPONSE_SERIALIZATION_SECONDS = Histogram(
+    "response_serialization_seconds",
+    "Time to encode a response body.",
+    ["format"],  # json | ndjson (per streamed batch)
+    buckets=_FAST_BUCKETS,
+)
+
+# -----------------------------------------------------------------------------
+# Batched user-by-id reads (loader.BatchLoader)
+# -----------------------------------------------------------------------------
+USER_LOADER_BATCH_SIZE = Histogram(
+    "user_loader_batch_size",
+    "Distinct user IDs per batched user-by-id query.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+USER_LOADER_WAIT_SECONDS = Histogram(
+    "user_loader_wait_seconds",
+    "Time a user-by-id lookup waited for its batch to be sent.",
+    buckets=_FAST_BUCKETS,
+)
+
+# -----------------------------------------------------------------------------
+# Single-flight (singleflight.SingleFlight)
+# -----------------------------------------------------------------------------
+SINGLEFLIGHT_SHARED = Counter(
+    "singleflight_shared_total",
+    "Calls that joined an identical call already in flight instead of running their own.",
+    ["group"],  # profile | readiness
+)
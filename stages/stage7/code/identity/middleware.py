@@ -0,0 +1,109 @@
+# ASGI middleware for the identity service.
+#
+# Both classes are plain ASGI callables rather than @app.middleware("http")
+# / BaseHTTPMiddleware. The latter runs every request through an extra task
+# plus a memory stream that copies the response body chunk by chunk — a
+# fixed per-request cost on top of CORS and the OTEL instrumentation, paid
+# by every kubelet probe and Prometheus scrape. bench/middleware.py
+# measures the difference.
+#
+#   - RequestIDMiddleware: adopts the caller's X-Request-ID (or makes one),
+#     exposes it as request.state.request_id and the `request_id`
+#     contextvar (log_json adds it to every log line, next to the OTEL
+#     trace_id), and echoes it on the response.
+#   - FastLaneMiddleware: sends probe and /metrics GET requests straight to
+#     the router, skipping every middleware registered before it — no CORS,
+#     no OTEL span, no request ID. Those endpoints are hit every few seconds
+#     per pod and need none of it. Any other method goes through the full
+#     stack: the router alone raises 405 as an exception, and only FastAPI's
+#     ExceptionMiddleware turns that into a response.
+#
+# Two hooks on the router side feed the request metrics in metrics.py:
+#
+#   - InstrumentedRoute (app.router.route_class): http_requests_in_flight
+#     per route template, counted until the response body is fully sent
+#     (streamed exports included) and also for fast-lane requests.
+#   - TimedJSONResponse (default_response_class): times json.dumps of the
+#     body a handler returned, response_serialization_seconds{format="json"}.
+import contextvars
+import time
+import uuid
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+
+from metrics import HTTP_IN_FLIGHT, RESPONSE_SERIALIZATION_SECONDS
+
+REQUEST_ID_HEADER = b"x-request-id"
+
+request_id = contextvars.ContextVar("request_id", default="")
+
+
+class RequestIDMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        rid = ""
+        for name, value in scope["headers"]:
+            if name == REQUEST_ID_HEADER:
+                rid = value.decode("latin-1")
+                break
+        if not rid:
+            rid = str(uuid.uuid4())
+        scope.setdefault("state", {})["request_id"] = rid
+        header = (REQUEST_ID_HEADER, rid.encode("latin-1"))
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    h for h in message.get("headers", ()) if h[0].lower() != REQUEST_ID_HEADER
+                ] + [header]
+            await send(message)
+
+        token = request_id.set(rid)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id.reset(token)
+
+
+class FastLaneMiddleware:
+    """Route GET requests for `paths` to `fast_app` (normally app.router),
+    bypassing the rest of the middleware stack. Must be added last so it
+    is the outermost layer."""
+
+    def __init__(self, app, fast_app, paths):
+        self.app = app
+        self.fast_app = fast_app
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.paths and scope["method"] == "GET":
+            await self.fast_app(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+
+
+class InstrumentedRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        super().__init__(path, endpoint, **kwargs)
+        self._in_flight = HTTP_IN_FLIGHT.labels(route=self.path)
+
+    async def handle(self, scope, receive, send):
+        self._in_flight.inc()
+        try:
+            await super().handle(scope, receive, send)
+        finally:
+            self._in_flight.dec()
+
+
+class TimedJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        body = super().render(content)
+        RESPONSE_SERIALIZATION_SECONDS.labels(format="json").observe(time.perf_counter() - start)
+        return body
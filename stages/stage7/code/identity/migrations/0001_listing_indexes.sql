@@ -0,0 +1,13 @@
+-- Indexes init.sql gained after the first identity databases were created
+-- (init.sql only runs on an empty data dir, so those never got them).
+-- IF NOT EXISTS: a database initialised from the current init.sql has
+-- them already.
+
+-- GET /api/admin/users: newest first on (created_at, id), optionally
+-- filtered by role or tier (keyset pagination, queries.list_users).
+CREATE INDEX IF NOT EXISTS users_created_at_id_idx ON users (created_at, id);
+CREATE INDEX IF NOT EXISTS users_role_created_at_id_idx ON users (role, created_at, id);
+CREATE INDEX IF NOT EXISTS users_tier_created_at_id_idx ON users (loyalty_tier, created_at, id);
+
+-- If-None-Match checks (queries.user_version): index-only by id.
+CREATE INDEX IF NOT EXISTS users_id_version_idx ON users (id) INCLUDE (updated_at, is_active);
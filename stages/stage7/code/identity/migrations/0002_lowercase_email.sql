@@ -0,0 +1,8 @@
+-- Case-insensitive email: addresses are stored lowercase (the service
+-- lowercases them on register and login), so lookups stay a plain
+-- `email = $1` on the unique index instead of lower(email) everywhere.
+--
+-- Fails on the UPDATE if two accounts differ only in case; merge or
+-- rename one of them and run the migrations again.
+UPDATE users SET email = lower(email) WHERE email <> lower(email);
+ALTER TABLE users ADD CONSTRAINT users_email_lowercase CHECK (email = lower(email));
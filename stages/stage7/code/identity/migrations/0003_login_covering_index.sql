@@ -0,0 +1,10 @@
+-- Login (queries.CREDENTIALS_BY_EMAIL) reads id, email, password_hash,
+-- role, loyalty_tier and is_active by email. With the other five columns
+-- INCLUDEd the lookup is an index-only scan that doesn't visit the heap.
+--
+-- The index is unique, so it replaces the UNIQUE constraint's own index
+-- on email (one index to maintain per write, not two); INSERT ... ON
+-- CONFLICT (email) infers either.
+CREATE UNIQUE INDEX IF NOT EXISTS users_email_login_idx
+    ON users (email) INCLUDE (id, password_hash, role, loyalty_tier, is_active);
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_email_key;
@@ -0,0 +1,6 @@
+-- Registration claims (queries.CLAIM_EMAIL) are users rows with an empty
+-- password_hash until the signup completes. queries.delete_expired_claims
+-- sweeps the abandoned ones periodically; this partial index holds only
+-- those rows, so the sweep reads nothing when there are none.
+CREATE INDEX IF NOT EXISTS users_pending_claim_idx
+    ON users (created_at) WHERE password_hash = '';
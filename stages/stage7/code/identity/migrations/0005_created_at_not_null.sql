@@ -0,0 +1,10 @@
+-- Keyset pagination (queries.list_users) and the listing cursor compare
+-- (created_at, id); a NULL created_at matches neither side of `<`, so
+-- such users silently never appear past the first page. init.sql declares
+-- the column NOT NULL, but that only reaches databases created after it.
+--
+-- Rows from before then get their updated_at, or the epoch if that is
+-- NULL too — either way they sort as the oldest accounts. A no-op on
+-- databases that were created with the constraint.
+UPDATE users SET created_at = COALESCE(updated_at, TIMESTAMP 'epoch') WHERE created_at IS NULL;
+ALTER TABLE users ALTER COLUMN created_at SET NOT NULL;
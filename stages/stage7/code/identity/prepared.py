@@ -0,0 +1,94 @@
+# Server-side prepared statements and compact row records for the hot
+# identity queries (queries.py).
+#
+# Sent as plain text, every statement is parsed, analysed and planned by
+# Postgres on each request. A Statement is PREPAREd on a connection the
+# first time it runs there and EXECUTEd by name from then on: parse and
+# analysis happen once per connection, and after a few executions Postgres
+# switches to a cached generic plan when it is no worse than a custom one.
+# Prepared statements belong to the server session, so each pooled
+# connection remembers what it has prepared (db.py's connections carry a
+# `prepared` set); a new or reconnected connection starts empty and
+# prepares again. This needs session-level pooling — behind a
+# transaction-mode PgBouncer the next EXECUTE may land on another backend.
+#
+# Rows come back as plain tuples and are decoded into Record subclasses:
+# one __slots__ attribute per selected column instead of a RealDictCursor
+# dict per row, so a row is smaller and cheaper to build. Records also
+# answer row["column"], keys() and `in` like the dict rows the rest of
+# queries.py returns, so the cache and handlers take either.
+
+
+class Record:
+    """A row with one slot per selected column; subclasses list the
+    columns, in SELECT order, as __slots__. Treat as read-only — records
+    are shared between requests through the profile cache."""
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for column, value in zip(self.__slots__, values):
+            setattr(self, column, value)
+
+    def __getitem__(self, column):
+        try:
+            return getattr(self, column)
+        except AttributeError:
+            raise KeyError(column) from None
+
+    def __contains__(self, column):
+        return column in self.__slots__
+
+    def keys(self):
+        return self.__slots__
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(self[c] == other[c] for c in self.__slots__)
+
+    def __repr__(self):
+        fields = ", ".join(f"{c}={self[c]!r}" for c in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class Statement:
+    """`sql` with $1..$n placeholders of `param_types`, prepared as `name`
+    on each connection the first time it is executed there."""
+
+    def __init__(self, name: str, param_types, sql: str):
+        self.name = name
+        self.prepare_sql = f"PREPARE {name} ({', '.join(param_types)}) AS {sql}"
+        # Typed placeholders: psycopg2 sends a list as ARRAY['...'], text[],
+        # which EXECUTE won't coerce to e.g. uuid[] on its own.
+        self.execute_sql = f"EXECUTE {name} ({', '.join(f'%s::{t}' for t in param_types)})"
+
+    def prepare(self, conn, cur):
+        if self.name not in conn.prepared:
+            cur.execute(self.prepare_sql)
+            conn.prepared.add(self.name)
+
+    def fetchone(self, conn, *params):
+        """The first result row as a tuple, or None."""
+        cur = self._execute(conn, params)
+        try:
+            return cur.fetchone()
+        finally:
+            cur.close()
+
+    def fetchall(self, conn, *params):
+        """All result rows, as tuples."""
+        cur = self._execute(conn, params)
+        try:
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    def _execute(self, conn, params):
+        cur = conn.cursor()
+        try:
+            self.prepare(conn, cur)
+            cur.execute(self.execute_sql, params)
+        except BaseException:
+            cur.close()
+            raise
+        return cur
@@ -0,0 +1,316 @@
+# SQL for the identity service.
+#
+# Every function takes a pooled psycopg2 connection as its first argument
+# and is blocking, so handlers call them through `await db_pool.run(fn,
+# ...)` (db.ConnectionPool.run) which executes them on the DB executor
+# instead of the event loop.
+#
+# The per-request statements (login, register, profile read and update,
+# the ETag check) are prepared once per connection and return only the
+# columns their endpoint uses, decoded into records (prepared.py). The
+# admin listing, batch and export queries build their SQL from the
+# requested fields and stay plain RealDictCursor queries.
+from psycopg2.extras import RealDictCursor
+
+from prepared import Record, Statement
+
+# Columns update_user() may touch, in UPDATE_USER's parameter order.
+UPDATABLE_COLUMNS = ("first_name", "last_name", "passport_number")
+
+# API field name -> users column, for endpoints that let the caller pick
+# which fields come back. Callers pass keys of this dict, and only its
+# values are interpolated into SQL, so that is safe.
+USER_FIELDS = {
+    "id": "id",
+    "email": "email",
+    "firstName": "first_name",
+    "lastName": "last_name",
+    "passportNumber": "passport_number",
+    "loyaltyTier": "loyalty_tier",
+    "role": "role",
+    "isActive": "is_active",
+    "createdAt": "created_at",
+}
+
+
+def ping(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT 1")
+    cur.close()
+
+
+class Profile(Record):
+    """What the profile endpoints return, plus what their ETag and active
+    checks need."""
+    __slots__ = ("id", "email", "first_name", "last_name", "passport_number",
+                 "loyalty_tier", "role", "is_active", "updated_at")
+
+
+class Credentials(Record):
+    """What login needs: the hash to verify and the JWT claims."""
+    __slots__ = ("id", "email", "password_hash", "role", "loyalty_tier", "is_active")
+
+
+class NewUser(Record):
+    """What register returns."""
+    __slots__ = ("id", "email", "loyalty_tier", "role")
+
+
+_PROFILE = ", ".join(Profile.__slots__)
+
+# Accounts still being registered (see CLAIM_EMAIL) have no hash yet: every
+# read that returns users leaves them out, so they can't log in and don't
+# show up as users anywhere. USER_VERSION doesn't filter, to stay an
+# index-only scan; its answer is only used with an ETag, which a claim
+# never had, since USER_BY_ID doesn't return it.
+_REGISTERED = "password_hash <> ''"
+
+USER_BY_ID = Statement(
+    "user_by_id", ["uuid"],
+    f"SELECT {_PROFILE} FROM users WHERE id = $1 AND {_REGISTERED}"
+)
+USERS_BY_IDS = Statement(
+    "users_by_ids", ["uuid[]"],
+    f"SELECT {_PROFILE} FROM users WHERE id = ANY($1) AND {_REGISTERED}"
+)
+USER_VERSION = Statement(
+    "user_version", ["uuid"],
+    "SELECT updated_at, is_active FROM users WHERE id = $1"
+)
+CREDENTIALS_BY_EMAIL = Statement(
+    "credentials_by_email", ["varchar"],
+    f"SELECT {', '.join(Credentials.__slots__)} FROM users WHERE email = $1 AND {_REGISTERED}"
+)
+# Registration in two writes around the bcrypt hash. CLAIM_EMAIL inserts
+# the account with an empty password_hash, or returns nothing if the email
+# is taken — the unique index decides, so of two concurrent signups for
+# one address exactly one gets the claim and only that one is hashed.
+# COMPLETE_REGISTRATION stores the hash and returns the new user. A claim
+# whose request died before completing (crash, hash queue full) is
+# released by RELEASE_CLAIM, or taken over by the next signup for that
+# email once it is CLAIM_TTL old. Claims nobody takes over are deleted by
+# delete_expired_claims(), which main.py runs periodically.
+CLAIM_TTL = "5 minutes"
+CLAIM_EMAIL = Statement(
+    "claim_email", ["varchar"],
+    f"""INSERT INTO users (email, password_hash)
+           VALUES ($1, '')
+           ON CONFLICT (email) DO UPDATE SET created_at = NOW(), updated_at = NOW()
+               WHERE users.password_hash = '' AND users.created_at < NOW() - INTERVAL '{CLAIM_TTL}'
+           RETURNING id"""
+)
+COMPLETE_REGISTRATION = Statement(
+    "complete_registration", ["uuid", "varchar"],
+    f"""UPDATE users SET password_hash = $2
+           WHERE id = $1 AND password_hash = ''
+           RETURNING {', '.join(NewUser.__slots__)}"""
+)
+RELEASE_CLAIM = Statement(
+    "release_claim", ["uuid"],
+    "DELETE FROM users WHERE id = $1 AND password_hash = '' RETURNING id"
+)
+# One statement for every combination of changed fields: a NULL parameter
+# keeps the column as it is.
+UPDATE_USER = Statement(
+    "update_user", ["uuid", "varchar", "varchar", "varchar"],
+    f"""UPDATE users SET first_name = COALESCE($2, first_name),
+                            last_name = COALESCE($3, last_name),
+                            passport_number = COALESCE($4, passport_number),
+                            updated_at = NOW()
+           WHERE id = $1
+           RETURNING {_PROFILE}"""
+)
+STATEMENTS = (USER_BY_ID, USERS_BY_IDS, USER_VERSION, CREDENTIALS_BY_EMAIL, CLAIM_EMAIL, COMPLETE_REGISTRATION,
+              RELEASE_CLAIM, UPDATE_USER)
+
+
+# Matches no row: warm_up() runs the hot lookups without reading a user.
+_NO_USER = "00000000-0000-0000-0000-000000000000"
+
+
+def warm_up(conn):
+    """Prepare the hot statements on `conn` and run the lookups once, so
+    the first real request on this connection doesn't pay for Postgres'
+    parsing, catalog lookups and planning (or psycopg2's type adaptation)
+    on its own."""
+    cur = conn.cursor()
+    for statement in STATEMENTS:
+        statement.prepare(conn, cur)
+    cur.close()
+    user_by_id(conn, _NO_USER)
+    user_version(conn, _NO_USER)
+    user_by_email(conn, "")
+
+
+def claim_email(conn, email):
+    """The new user's id if `email` was free (see CLAIM_EMAIL), else None."""
+    row = CLAIM_EMAIL.fetchone(conn, email)
+    return row[0] if row is not None else None
+
+
+def complete_registration(conn, user_id, password_hash):
+    """Store the hash for a claimed account; the NewUser, or None if the
+    claim no longer exists."""
+    row = COMPLETE_REGISTRATION.fetchone(conn, user_id, password_hash)
+    return NewUser(*row) if row is not None else None
+
+
+def release_claim(conn, user_id):
+    RELEASE_CLAIM.fetchone(conn, user_id)
+
+
+def delete_expired_claims(conn):
+    """Delete claims older than CLAIM_TTL whose registration never
+    completed (users_pending_claim_idx); returns how many."""
+    cur = conn.cursor()
+    cur.execute(
+        f"DELETE FROM users WHERE password_hash = '' AND created_at < NOW() - INTERVAL '{CLAIM_TTL}'"
+    )
+    deleted = cur.rowcount
+    cur.close()
+    return deleted
+
+
+def user_by_email(conn, email):
+    """Credentials for `email`, or None."""
+    row = CREDENTIALS_BY_EMAIL.fetchone(conn, email)
+    return Credentials(*row) if row is not None else None
+
+
+def update_password_hash(conn, user_id, old_hash, new_hash):
+    """Swap in a re-hashed password unless it changed since it was read."""
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE users SET password_hash = %s WHERE id = %s AND password_hash = %s",
+        (new_hash, user_id, old_hash)
+    )
+    updated = cur.rowcount == 1
+    cur.close()
+    return updated
+
+
+def user_by_id(conn, user_id):
+    """The Profile for `user_id`, or None."""
+    row = USER_BY_ID.fetchone(conn, user_id)
+    return Profile(*row) if row is not None else None
+
+
+def profiles_by_ids(conn, user_ids):
+    """{id: Profile} for the `user_ids` (canonical UUID strings) that exist,
+    in one primary-key index scan — loader.BatchLoader's fetch."""
+    return {row[0]: Profile(*row) for row in USERS_BY_IDS.fetchall(conn, list(user_ids))}
+
+
+def user_version(conn, user_id):
+    """(updated_at, is_active) for a user, or None — all an If-None-Match
+    check needs. users_id_version_idx covers both columns, so this is an
+    index-only scan that never touches the table row."""
+    return USER_VERSION.fetchone(conn, user_id)
+
+
+def update_user(conn, user_id, changes: dict):
+    """Apply `changes` ({column: value}, columns from UPDATABLE_COLUMNS) and
+    return the updated Profile, or None if there is no such user."""
+    row = UPDATE_USER.fetchone(conn, user_id, *(changes.get(c) for c in UPDATABLE_COLUMNS))
+    return Profile(*row) if row is not None else None
+
+
+def users_by_ids(conn, user_ids, fields):
+    """Rows for `user_ids` (UUID strings) in one query: `= ANY(array)` is a
+    single primary-key index scan however many IDs are passed. Only the
+    columns for `fields` (keys of USER_FIELDS) are selected, plus id."""
+    columns = ["id"] + [USER_FIELDS[f] for f in fields if f != "id"]
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(
+        f"SELECT {', '.join(columns)} FROM users WHERE id = ANY(%s::uuid[]) AND {_REGISTERED}",
+        (list(user_ids),)
+    )
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+def _user_filters(after, role, tier, is_active):
+    """WHERE conditions + params shared by the listing and count_users."""
+    where = [_REGISTERED]
+    params = []
+    if after is not None:
+        where.append("(created_at, id) < (%s, %s::uuid)")
+        params.extend(after)
+    if role is not None:
+        where.append("role = %s")
+        params.append(role)
+    if tier is not None:
+        where.append("loyalty_tier = %s")
+        params.append(tier)
+    if is_active is not None:
+        where.append("is_active = %s")
+        params.append(is_active)
+    return where, params
+
+
+def _user_listing(fields, after, role, tier, is_active):
+    """SELECT (without LIMIT) + params shared by list_users and the export
+    cursor: newest first on (created_at, id), optional filters."""
+    columns = ["id", "created_at"] + [
+        USER_FIELDS[f] for f in fields if f not in ("id", "createdAt")
+    ]
+    where, params = _user_filters(after, role, tier, is_active)
+    sql = f"""SELECT {', '.join(columns)} FROM users
+           WHERE {' AND '.join(where)}
+           ORDER BY created_at DESC, id DESC"""
+    return sql, params
+
+
+def list_users(conn, fields, limit, after=None, role=None, tier=None, is_active=None):
+    """One page of users, newest first, with only the columns for `fields`.
+
+    Keyset pagination: `after` is the (created_at, id) of the last row of
+    the previous page, and the row comparison below walks the (created_at,
+    id) index from there — page N costs the same as page 1, unlike OFFSET.
+    id breaks ties between users created in the same microsecond.
+
+    Fetches limit + 1 rows; the caller uses the extra one only to tell
+    whether there is a next page.
+    """
+    sql, params = _user_listing(fields, after, role, tier, is_active)
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    cur.execute(sql + "\n           LIMIT %s", tuple(params) + (limit + 1,))
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+
+def count_users(conn, role=None, tier=None, is_active=None):
+    """How many users match the list_users filters, across all pages."""
+    where, params = _user_filters(None, role, tier, is_active)
+    cur = conn.cursor()
+    cur.execute(f"SELECT count(*) FROM users WHERE {' AND '.join(where)}", tuple(params))
+    (total,) = cur.fetchone()
+    cur.close()
+    return total
+
+
+# Full-table export. A named cursor makes Postgres keep the result set on
+# its side; the client pulls `size` rows per fetch_users(), so memory in
+# this process stays at one batch however big the table is. Named cursors
+# only live inside a transaction, hence autocommit off here and back on in
+# close_user_export (or in ConnectionPool.putconn if the export is
+# abandoned). Use with ConnectionPool.hold(): all three calls must run on
+# the same connection.
+def open_user_export(conn, fields, after=None, role=None, tier=None, is_active=None):
+    sql, params = _user_listing(fields, after, role, tier, is_active)
+    conn.autocommit = False
+    cur = conn.cursor(name="user_export", cursor_factory=RealDictCursor)
+    cur.execute(sql, tuple(params))
+    return cur
+
+
+def fetch_users(conn, cur, size):
+    return cur.fetchmany(size)
+
+
+def close_user_export(conn, cur):
+    cur.close()
+    conn.rollback()
+    conn.autocommit = True
@@ -0,0 +1,115 @@
+# Readiness state for the identity service, kept current in the background.
+#
+# /healthz/ready and /readyz used to run `SELECT 1` through the pool on
+# every kubelet probe — per pod, every few seconds, plus a Redis PING —
+# and a probe that queued behind busy requests for a connection could time
+# out and mark a merely busy pod unready. ReadinessMonitor runs the checks
+# on its own schedule instead and the probes answer from memory:
+#
+#   - every `interval` seconds: `SELECT 1` through the pool (bounded by
+#     `timeout`), pool waiters, bcrypt queue depth, and the Redis status
+#     (reported, never a reason to be unready — Redis down only costs
+#     latency).
+#   - saturation: more than `max_db_waiters` callers queued for a
+#     connection (waiting for a DB executor thread or in checkout — see
+#     ConnectionPool.stats), or the bcrypt queue at `max_hash_fill` of its capacity,
+#     on `saturated_checks` consecutive checks, makes the pod unready so
+#     the Service sends new requests to the other replicas. One clean check
+#     makes it ready again. If every replica is saturated they all drop
+#     out, so keep the thresholds at "shedding load anyway" levels; 0
+#     disables a check.
+#   - broken hash pool: a bcrypt worker process died and HashPool is
+#     rebuilding its workers; unready until the new ones have warmed up.
+#   - staleness: a snapshot older than a few intervals (blocked event
+#     loop, dead task) counts as unready.
+#
+# Before the first check the pod is not ready. Overlapping check() calls
+# (warm-up, the loop) share one run.
+import asyncio
+import time
+
+from singleflight import SingleFlight
+
+
+class ReadinessMonitor:
+    def __init__(self, pool, ping, hash_pool, shared_cache, interval: float = 2.0,
+                 timeout: float = 1.0, max_db_waiters: int = 10, max_hash_fill: float = 1.0,
+                 saturated_checks: int = 2):
+        self.pool = pool
+        self.ping = ping  # ping(conn), run through pool.run
+        self.hash_pool = hash_pool
+        self.shared_cache = shared_cache
+        self.interval = interval
+        self.timeout = timeout
+        self.max_db_waiters = max_db_waiters
+        self.max_hash_fill = max_hash_fill
+        self.saturated_checks = saturated_checks
+        self.ready = False
+        self.reasons = ["not checked yet"]
+        self.cache = "disabled"
+        self.checked_at = None
+        self._saturated = 0
+        self._task = None
+        self._flights = SingleFlight("readiness")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def status(self):
+        """(ready, reasons, cache status) as of the last check."""
+        if self.checked_at is None:
+            return False, self.reasons, self.cache
+        age = time.monotonic() - self.checked_at
+        if age > 3 * self.interval + self.timeout:
+            return False, [f"readiness check stale ({age:.1f}s old)"], self.cache
+        return self.ready, self.reasons, self.cache
+
+    async def check(self):
+        await self._flights.do("check", self._check)
+
+    async def _check(self):
+        reasons = []
+        try:
+            await asyncio.wait_for(self.pool.run(self.ping), self.timeout)
+        except asyncio.TimeoutError:
+            reasons.append(f"database did not answer within {self.timeout}s")
+        except Exception as e:
+            reasons.append(f"database unreachable: {e}")
+
+        if self.hash_pool.broken:
+            reasons.append("password hashing workers restarting after a worker died")
+
+        saturation = []
+        waiters = self.pool.stats()["waiters"]
+        if self.max_db_waiters > 0 and waiters > self.max_db_waiters:
+            saturation.append(f"{waiters} requests waiting for a database connection")
+        pending, capacity = self.hash_pool.pending, self.hash_pool.max_pending
+        if self.max_hash_fill > 0 and pending >= self.max_hash_fill * capacity:
+            saturation.append(f"password hashing queue at {pending}/{capacity}")
+        self._saturated = self._saturated + 1 if saturation else 0
+        if self._saturated >= self.saturated_checks:
+            reasons.extend(saturation)
+
+        self.cache = await self.shared_cache.status()
+        self.ready = not reasons
+        self.reasons = reasons
+        self.checked_at = time.monotonic()
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                self.ready, self.reasons = False, [f"readiness check failed: {e}"]
+                self.checked_at = time.monotonic()
+            await asyncio.sleep(self.interval)
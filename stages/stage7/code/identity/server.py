@@ -0,0 +1,254 @@
+# Production entry point for the identity service: a pre-fork uvicorn
+# supervisor.
+#
+# A single uvicorn process runs Python on one core at a time, and bcrypt
+# (in its process pool) is not the only CPU work: JSON encoding, JWT
+# checks and the request plumbing all hold the GIL. server.py binds the
+# listen socket once and forks WEB_CONCURRENCY uvicorn workers that all
+# accept on it:
+#
+#   - worker count: WEB_CONCURRENCY=N, or "auto" (default) for the pod's
+#     CPU limit — the cgroup v2 cpu.max / v1 cfs quota, rounded down, at
+#     least 1 — capped by the CPUs this process may run on. os.cpu_count()
+#     alone would count the node's cores.
+#   - Postgres budget: DB_POOL_BUDGET is the connection count for the whole
+#     pod; each worker gets DB_POOL_MAX_SIZE = budget // workers (at least
+#     1), so replicas x DB_POOL_BUDGET is what has to fit under
+#     max_connections however many workers a pod runs. Without it,
+#     DB_POOL_MAX_SIZE stays per worker. HASH_WORKERS is per worker too.
+#     When it is unset, each worker gets the pod's CPUs divided by the
+#     worker count, at least 1.
+#   - metrics: with more than one worker, PROMETHEUS_MULTIPROC_DIR is set
+#     (a fresh temp dir unless given) and emptied before forking; the
+#     supervisor calls mark_process_dead for every worker that exits (see
+#     metrics.py).
+#   - drain: SIGTERM/SIGINT are forwarded to every worker, which stops
+#     accepting and finishes in-flight requests within GRACEFUL_TIMEOUT
+#     seconds (uvicorn's timeout_graceful_shutdown). Workers still alive
+#     shortly after that are killed. A worker that exits on its own is
+#     replaced.
+#
+# The supervisor imports neither main.py nor anything that starts threads
+# before forking; each worker imports the app itself. With one worker it
+# just runs uvicorn in-process, as before.
+#
+#   python server.py [--port 8080] [--workers auto]
+import argparse
+import glob
+import json
+import math
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import uvicorn
+
+SERVICE = "identity-service"
+RESTART_DELAY = 1.0
+
+
+def _log(level: str, message: str, **fields):
+    # Same line format as main.log_json; the supervisor can't import main.
+    entry = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "level": level,
+        "service": SERVICE,
+        "trace_id": "",
+        "span_id": "",
+        "message": message,
+    }
+    entry.update(fields)
+    print(json.dumps(entry), flush=True)
+
+
+def cpu_limit():
+    """CPUs granted by the cgroup quota, or None if unlimited/unknown."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:  # cgroup v2
+            quota, period = f.read().split()
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:  # cgroup v1
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read())
+    except (OSError, ValueError):
+        return None
+    return quota / period if quota > 0 and period > 0 else None
+
+
+def available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def worker_count(setting: str) -> int:
+    if setting != "auto":
+        return max(int(setting), 1)
+    cpus = available_cpus()
+    limit = cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, math.floor(limit))
+    return max(cpus, 1)
+
+
+def configure_pool(workers: int):
+    """Split DB_POOL_BUDGET across workers via the env they inherit."""
+    budget = os.getenv("DB_POOL_BUDGET")
+    if not budget:
+        return
+    os.environ["DB_POOL_MAX_SIZE"] = str(max(int(budget) // workers, 1))
+
+
+def configure_hash_workers(workers: int):
+    """Default HASH_WORKERS to this worker's share of the CPU limit."""
+    if not os.getenv("HASH_WORKERS"):
+        os.environ["HASH_WORKERS"] = str(max(worker_count("auto") // workers, 1))
+
+
+def prepare_metrics_dir(workers: int):
+    path = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if not path:
+        if workers == 1:
+            return
+        path = os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus-")
+    os.makedirs(path, exist_ok=True)
+    # Files from a previous run would be summed into this one.
+    for stale in glob.glob(os.path.join(path, "*.db")):
+        os.remove(stale)
+
+
+def make_config(args) -> uvicorn.Config:
+    return uvicorn.Config(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        access_log=False,
+    )
+
+
+def bind(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Supervisor:
+    def __init__(self, args, workers: int):
+        self.args = args
+        self.workers = workers
+        self.sock = bind(args.host, args.port)
+        self.children = {}  # pid -> started_at
+        self.stopping = False
+        self.stop_deadline = None
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        for _ in range(self.workers):
+            self._spawn()
+        _log("INFO", "Supervisor started", workers=self.workers, pids=sorted(self.children))
+        while self.children:
+            self._reap()
+            if self.stopping and time.monotonic() > self.stop_deadline:
+                for pid in self.children:
+                    _log("WARN", "Worker did not drain in time, killing", pid=pid)
+                    self._kill(pid, signal.SIGKILL)
+                self.stop_deadline = float("inf")
+            time.sleep(0.2)
+        self.sock.close()
+        _log("INFO", "Supervisor stopped")
+        return 0
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                uvicorn.Server(make_config(self.args)).run(sockets=[self.sock])
+            except BaseException:
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue  # not a worker (e.g. a stray grandchild)
+            # Not metrics.mark_process_dead: importing metrics.py here would
+            # register the supervisor's own (always zero) gauges.
+            if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+                from prometheus_client import multiprocess
+                multiprocess.mark_process_dead(pid)
+            if self.stopping:
+                continue
+            _log("WARN", "Worker exited, restarting", pid=pid,
+                 exit_code=os.waitstatus_to_exitcode(status),
+                 uptime_s=round(time.monotonic() - started, 1))
+            if time.monotonic() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)  # don't spin on a crash at import
+            self._spawn()
+
+    def _on_signal(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        self.stop_deadline = time.monotonic() + self.args.graceful_timeout + 2
+        _log("INFO", "Received shutdown signal, draining workers", signal=signal.Signals(signum).name)
+        for pid in self.children:
+            self._kill(pid, signal.SIGTERM)
+
+    @staticmethod
+    def _kill(pid: int, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run the identity service.")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8080")))
+    parser.add_argument("--workers", default=os.getenv("WEB_CONCURRENCY", "auto"),
+                        help='number of worker processes, or "auto" for the CPU limit')
+    parser.add_argument("--graceful-timeout", type=float, default=float(os.getenv("GRACEFUL_TIMEOUT", "30")))
+    args = parser.parse_args(argv)
+
+    workers = worker_count(args.workers)
+    configure_pool(workers)
+    configure_hash_workers(workers)
+    prepare_metrics_dir(workers)
+    if workers == 1:
+        uvicorn.Server(make_config(args)).run()
+        return 0
+    return Supervisor(args, workers).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
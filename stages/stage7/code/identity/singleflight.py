@@ -0,0 +1,62 @@
+# Single-flight: concurrent calls for the same key share one execution.
+#
+# When a popular profile (the seeded admin, a corporate booker) drops out
+# of the cache, or a pod has just started with an empty one, every
+# request for it at that moment ran its own Redis GET and Postgres query.
+# SingleFlight.do(key, fn) runs `await fn()` for the first caller; callers
+# that arrive with the same key while it is in flight await the same
+# result:
+#
+#   - an exception reaches every waiter. Nothing is remembered afterwards,
+#     so the next call tries again — this is not a cache;
+#   - a cancelled waiter (client gone, request timeout) only stops
+#     waiting. The call itself is cancelled once its last waiter is gone,
+#     and a caller arriving after that starts a fresh one;
+#   - singleflight_shared_total{group} counts the calls that joined one in
+#     flight.
+#
+# Event-loop only, like the caches.
+import asyncio
+
+from metrics import SINGLEFLIGHT_SHARED
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}  # key -> _Call
+
+    async def do(self, key, fn):
+        """The result of `await fn()`, shared with concurrent callers
+        passing the same `key`."""
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = _Call(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+        else:
+            SINGLEFLIGHT_SHARED.labels(group=self.name).inc()
+        call.waiters += 1
+        try:
+            # shield: one waiter being cancelled mustn't cancel the call
+            # for the others.
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,230 @@
+# OpenTelemetry tracing setup for the identity service.
+#
+# main.py used to trace every request and every query unconditionally. That
+# is a span per psycopg2 call (readiness pings included) and a full export
+# pipeline per request at any traffic level. Tracing configures it from the
+# environment:
+#
+#   - level (OTEL_TRACING_LEVEL):
+#       off      no tracer provider, no instrumentation, no exporter import.
+#                trace.get_current_span() is the no-op span, so log lines
+#                simply carry empty trace/span IDs.
+#       minimal  server spans from the FastAPI instrumentation only.
+#       full     (default) also psycopg2 query spans and outbound requests
+#                spans (traceparent propagation).
+#   - sampling: parent-based. A request that arrives with a traceparent
+#     follows the caller's decision; a new trace is kept with probability
+#     `ratio` (OTEL_TRACES_SAMPLER_ARG, by trace ID so every service agrees).
+#   - errors and slow requests are always kept: traces not picked by the
+#     ratio are still recorded (RECORD_ONLY) and buffered by
+#     TailKeepProcessor. When the local root span ends with an ERROR status
+#     (5xx or an unhandled exception, set by the ASGI instrumentation) or
+#     took at least `slow_ms`, the buffered spans are exported as if they
+#     had been sampled; otherwise they are discarded. The buffer is bounded
+#     (`max_traces` traces, `max_spans` spans each). With keep_errors off
+#     and slow_ms=0, unsampled traces aren't recorded at all.
+#   - probes: /healthz*, /readyz and /metrics bypass the OTEL middleware
+#     (FastLaneMiddleware), so the only spans they would produce are the
+#     readiness `SELECT 1` query spans, which have no server span above
+#     them. Root spans that aren't SERVER spans — queries and outbound
+#     calls outside any request — are dropped by the sampler.
+#   - export batching: BatchSpanProcessor reads the standard
+#     OTEL_BSP_MAX_QUEUE_SIZE, OTEL_BSP_MAX_EXPORT_BATCH_SIZE,
+#     OTEL_BSP_SCHEDULE_DELAY and OTEL_BSP_EXPORT_TIMEOUT itself.
+#
+# bench/tracing.py measures the per-request cost of each level.
+import threading
+from collections import OrderedDict
+
+from opentelemetry import trace
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor
+from opentelemetry.sdk.trace.sampling import (
+    Decision,
+    ParentBased,
+    Sampler,
+    SamplingResult,
+    TraceIdRatioBased,
+)
+from opentelemetry.trace import SpanContext, SpanKind, StatusCode, TraceFlags
+
+TRACING_LEVELS = ("off", "minimal", "full")
+
+
+class RootSampler(Sampler):
+    """Sampler for spans without a parent: drops non-SERVER roots, keeps a
+    `ratio` of the rest and, if `record_unsampled`, records the others
+    without sampling them (so TailKeepProcessor can still keep them)."""
+
+    def __init__(self, ratio: float, record_unsampled: bool):
+        self._ratio = TraceIdRatioBased(ratio)
+        self._record_unsampled = record_unsampled
+
+    def should_sample(self, parent_context, trace_id, name, kind=None,
+                      attributes=None, links=None, trace_state=None):
+        if kind is not None and kind != SpanKind.SERVER:
+            return SamplingResult(Decision.DROP)
+        result = self._ratio.should_sample(parent_context, trace_id, name, kind, attributes, links, trace_state)
+        if result.decision is Decision.DROP and self._record_unsampled:
+            return SamplingResult(Decision.RECORD_ONLY, result.attributes, result.trace_state)
+        return result
+
+    def get_description(self):
+        return f"RootSampler{{{self._ratio.get_description()},recordUnsampled:{self._record_unsampled}}}"
+
+
+class RecordIfParentRecords(Sampler):
+    """Children of a recorded-but-unsampled local span are recorded too, so
+    a promoted trace is exported whole."""
+
+    def should_sample(self, parent_context, trace_id, name, kind=None,
+                      attributes=None, links=None, trace_state=None):
+        if trace.get_current_span(parent_context).is_recording():
+            return SamplingResult(Decision.RECORD_ONLY)
+        return SamplingResult(Decision.DROP)
+
+    def get_description(self):
+        return "RecordIfParentRecords"
+
+
+def make_sampler(ratio: float, record_unsampled: bool) -> Sampler:
+    root = RootSampler(ratio, record_unsampled)
+    if not record_unsampled:
+        return ParentBased(root)
+    return ParentBased(root, local_parent_not_sampled=RecordIfParentRecords())
+
+
+def _sampled_copy(span: ReadableSpan) -> ReadableSpan:
+    ctx = span.context
+    context = SpanContext(ctx.trace_id, ctx.span_id, ctx.is_remote,
+                          TraceFlags(ctx.trace_flags | TraceFlags.SAMPLED), ctx.trace_state)
+    return ReadableSpan(
+        name=span.name,
+        context=context,
+        parent=span.parent,
+        resource=span.resource,
+        attributes=span.attributes,
+        events=span.events,
+        links=span.links,
+        kind=span.kind,
+        status=span.status,
+        start_time=span.start_time,
+        end_time=span.end_time,
+        instrumentation_scope=span.instrumentation_scope,
+    )
+
+
+class TailKeepProcessor(SpanProcessor):
+    """Pass sampled spans to `delegate`; buffer recorded-only spans per
+    trace and pass them on as sampled if the trace turns out to be an
+    error or slow. on_end runs on whichever thread ended the span (query
+    spans end in the pool's executor threads), hence the lock."""
+
+    def __init__(self, delegate: SpanProcessor, slow_ms: float, keep_errors: bool = True,
+                 max_traces: int = 2048, max_spans: int = 256):
+        self.delegate = delegate
+        self.slow_ns = int(slow_ms * 1e6)
+        self.keep_errors = keep_errors
+        self.max_traces = max_traces
+        self.max_spans = max_spans
+        self._traces = OrderedDict()  # trace_id -> [span, ...]
+        self._lock = threading.Lock()
+
+    def on_start(self, span, parent_context=None):
+        self.delegate.on_start(span, parent_context=parent_context)
+
+    def on_end(self, span: ReadableSpan):
+        if span.context.trace_flags.sampled:
+            self.delegate.on_end(span)
+            return
+        trace_id = span.context.trace_id
+        is_root = span.parent is None or span.parent.is_remote
+        with self._lock:
+            spans = self._traces.get(trace_id)
+            if spans is None:
+                spans = self._traces[trace_id] = []
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            if len(spans) < self.max_spans:
+                spans.append(span)
+            if not is_root:
+                return
+            del self._traces[trace_id]
+        if self._keep(span, spans):
+            for buffered in spans:
+                self.delegate.on_end(_sampled_copy(buffered))
+
+    def _keep(self, root: ReadableSpan, spans) -> bool:
+        if self.keep_errors and any(s.status.status_code is StatusCode.ERROR for s in spans):
+            return True
+        return self.slow_ns > 0 and root.end_time - root.start_time >= self.slow_ns
+
+    def shutdown(self):
+        self.delegate.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.delegate.force_flush(timeout_millis)
+
+
+class Tracing:
+    def __init__(self, level: str, endpoint: str, service_name: str, ratio: float = 1.0,
+                 slow_ms: float = 500, keep_errors: bool = True):
+        if level not in TRACING_LEVELS:
+            raise ValueError(f"unknown OTEL_TRACING_LEVEL: {level}")
+        self.level = level
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.ratio = min(max(ratio, 0.0), 1.0)
+        self.slow_ms = slow_ms
+        self.keep_errors = keep_errors
+        self.provider = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.level != "off"
+
+    def start(self):
+        """Install the tracer provider and the library instrumentations.
+        Call before the FastAPI app is created."""
+        if not self.enabled:
+            return
+        # Imported here so level=off doesn't even load the exporter (grpc).
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        # Below ratio 1 the tail-keep path needs unsampled traces recorded.
+        tail = self.ratio < 1.0 and (self.keep_errors or self.slow_ms > 0)
+        self.provider = TracerProvider(
+            resource=Resource.create({"service.name": self.service_name}),
+            sampler=make_sampler(self.ratio, record_unsampled=tail),
+        )
+        processor = BatchSpanProcessor(OTLPSpanExporter(endpoint=self.endpoint, insecure=True))
+        if tail:
+            processor = TailKeepProcessor(processor, self.slow_ms, self.keep_errors)
+        self.provider.add_span_processor(processor)
+        trace.set_tracer_provider(self.provider)
+        if self.level == "full":
+            from opentelemetry.instrumentation.psycopg2 import Psycopg2Instrumentor
+            from opentelemetry.instrumentation.requests import RequestsInstrumentor
+
+            # Every DB call becomes a child span; outbound HTTP calls
+            # propagate traceparent.
+            Psycopg2Instrumentor().instrument()
+            RequestsInstrumentor().instrument()
+
+    def instrument_app(self, app):
+        if not self.enabled:
+            return
+        from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+
+        FastAPIInstrumentor.instrument_app(app, tracer_provider=self.provider)
+
+    def close(self, timeout_millis: int = 2000):
+        """Flush pending spans (lifespan shutdown)."""
+        if self.provider is None:
+            return
+        try:
+            self.provider.force_flush(timeout_millis=timeout_millis)
+        except Exception:
+            pass
@@ -0,0 +1,199 @@
+# JWT helpers for the identity service.
+#
+# SigningKeys issues and verifies identity tokens. HS256 with the shared
+# JWT_SECRET is the default (and what booking verifies today). With
+# JWT_ALGORITHM=RS256 or ES256, tokens are signed with a private key and
+# carry a `kid` header; the matching public keys are published at
+# /.well-known/jwks.json so other services can verify tokens — and
+# authorize from the `role` / `tier` / `active` claims — without calling
+# identity or holding a secret that could mint tokens. (EdDSA would be
+# nicer still, but python-jose 3.3 cannot sign or verify it.)
+#
+#   - kid: the RFC 7638 JWK thumbprint of the public key, so it is stable
+#     across restarts and identical on every replica using the same key.
+#   - rotation: extra verify-only public keys (JWT_VERIFY_KEY_FILES) are
+#     accepted and published, so tokens signed by the previous key stay
+#     valid until they expire.
+#   - the algorithm is pinned per key, never taken from the token header
+#     alone (no alg-confusion between the HMAC secret and a public key).
+#   - HS256 tokens keep verifying while JWT_ACCEPT_HS256 is on, so
+#     switching algorithms doesn't log everybody out.
+#
+# TokenCache remembers payloads of tokens that already passed signature and
+# claim verification, so a client presenting the same bearer token again
+# (booking calls GET /api/users/{id} with one token over and over) skips
+# jwt.decode entirely.
+#
+#   - keyed by SHA-256 of the token: raw bearer tokens are never held in
+#     memory longer than the request that carried them.
+#   - expiry-aware: an entry is dropped once the token's own `exp` passes,
+#     so the cache can never accept a token jwt.decode would reject as
+#     expired. Tokens without `exp` are not cached at all.
+#   - bounded: at most `max_size` entries, least-recently-used evicted first.
+#
+# Only successful verifications are cached; a bad token pays full price
+# every time. All access happens on the event loop thread, so there is no
+# lock.
+import base64
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from jose import jwk, jwt, JWTError
+
+from metrics import JWT_CACHE_EVICTIONS, JWT_CACHE_HITS, JWT_CACHE_MISSES, JWT_CACHE_SIZE, JWT_SECONDS
+
+
+class TokenCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # digest -> (payload, exp)
+
+    def get(self, token: str):
+        """Return the cached payload for `token`, or None. Treat the
+        returned dict as read-only — it is shared between requests."""
+        if self.max_size <= 0:
+            return None
+        key = hashlib.sha256(token.encode()).digest()
+        entry = self._entries.get(key)
+        if entry is None:
+            JWT_CACHE_MISSES.inc()
+            return None
+        payload, exp = entry
+        if exp <= time.time():
+            del self._entries[key]
+            JWT_CACHE_EVICTIONS.labels(reason="expired").inc()
+            JWT_CACHE_SIZE.set(len(self._entries))
+            JWT_CACHE_MISSES.inc()
+            return None
+        self._entries.move_to_end(key)
+        JWT_CACHE_HITS.inc()
+        return payload
+
+    def put(self, token: str, payload: dict):
+        exp = payload.get("exp")
+        if self.max_size <= 0 or not isinstance(exp, (int, float)):
+            return
+        key = hashlib.sha256(token.encode()).digest()
+        self._entries[key] = (payload, exp)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            JWT_CACHE_EVICTIONS.labels(reason="lru").inc()
+        JWT_CACHE_SIZE.set(len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+ASYMMETRIC_ALGORITHMS = ("RS256", "ES256")
+
+
+def _b64url_uint(value: int, length: int = None) -> str:
+    length = length or (value.bit_length() + 7) // 8
+    return base64.urlsafe_b64encode(value.to_bytes(length, "big")).rstrip(b"=").decode()
+
+
+def _public_jwk(public_key) -> dict:
+    """Public JWK members for an RSA or P-256 key, without kid/alg/use."""
+    if isinstance(public_key, rsa.RSAPublicKey):
+        numbers = public_key.public_numbers()
+        return {"kty": "RSA", "n": _b64url_uint(numbers.n), "e": _b64url_uint(numbers.e)}
+    if isinstance(public_key, ec.EllipticCurvePublicKey) and isinstance(public_key.curve, ec.SECP256R1):
+        numbers = public_key.public_numbers()
+        return {"kty": "EC", "crv": "P-256",
+                "x": _b64url_uint(numbers.x, 32), "y": _b64url_uint(numbers.y, 32)}
+    raise ValueError(f"unsupported JWT key type: {type(public_key).__name__}")
+
+
+def _thumbprint(members: dict) -> str:
+    # RFC 7638: SHA-256 over the required members, sorted, no whitespace.
+    canonical = json.dumps(members, sort_keys=True, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(hashlib.sha256(canonical).digest()).rstrip(b"=").decode()
+
+
+class SigningKeys:
+    def __init__(self, algorithm: str, secret: str, private_key_pem: str = "",
+                 verify_key_pems=(), accept_hs256: bool = True):
+        if algorithm != "HS256" and algorithm not in ASYMMETRIC_ALGORITHMS:
+            raise ValueError(f"unsupported JWT_ALGORITHM: {algorithm}")
+        self.algorithm = algorithm
+        self.secret = secret
+        self.accept_hs256 = accept_hs256 or algorithm == "HS256"
+        self.kid = None
+        self.ephemeral = False
+        self._signing_key = None
+        self._verify_keys = {}  # kid -> (algorithm, jose Key)
+        self._jwks = []
+
+        if algorithm in ASYMMETRIC_ALGORITHMS:
+            if not private_key_pem:
+                # Dev convenience only: every replica would get its own key.
+                private_key_pem = self._generate(algorithm)
+                self.ephemeral = True
+            private_key = serialization.load_pem_private_key(private_key_pem.encode(), password=None)
+            self.kid = self._add_verify_key(private_key.public_key())
+            if self._verify_keys[self.kid][0] != algorithm:
+                raise ValueError(f"JWT private key does not match JWT_ALGORITHM={algorithm}")
+            self._signing_key = jwk.construct(private_key_pem, algorithm)
+
+        for pem in verify_key_pems:
+            self._add_verify_key(serialization.load_pem_public_key(pem.encode()))
+
+        self.jwks_json = json.dumps({"keys": self._jwks}, separators=(",", ":")).encode()
+
+    @staticmethod
+    def _generate(algorithm: str) -> str:
+        if algorithm == "RS256":
+            key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        else:
+            key = ec.generate_private_key(ec.SECP256R1())
+        return key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode()
+
+    def _add_verify_key(self, public_key) -> str:
+        members = _public_jwk(public_key)
+        algorithm = "RS256" if members["kty"] == "RSA" else "ES256"
+        kid = _thumbprint(members)
+        if kid not in self._verify_keys:
+            public_jwk = dict(members, kid=kid, alg=algorithm, use="sig")
+            self._verify_keys[kid] = (algorithm, jwk.construct(public_jwk, algorithm))
+            self._jwks.append(public_jwk)
+        return kid
+
+    def sign(self, claims: dict) -> str:
+        with JWT_SECONDS.labels(op="encode").time():
+            return self._sign(claims)
+
+    def _sign(self, claims: dict) -> str:
+        if self._signing_key is None:
+            return jwt.encode(claims, self.secret, algorithm="HS256")
+        return jwt.encode(claims, self._signing_key, algorithm=self.algorithm, headers={"kid": self.kid})
+
+    def decode(self, token: str) -> dict:
+        """Verify signature + claims; raises JWTError on any failure."""
+        with JWT_SECONDS.labels(op="decode").time():
+            return self._decode(token)
+
+    def _decode(self, token: str) -> dict:
+        header = jwt.get_unverified_header(token)
+        if not isinstance(header, dict):
+            raise JWTError("token header is not a JSON object")
+        if header.get("alg") == "HS256":
+            if not self.accept_hs256:
+                raise JWTError("HS256 tokens are no longer accepted")
+            return jwt.decode(token, self.secret, algorithms=["HS256"])
+        kid = header.get("kid")
+        if not isinstance(kid, str):
+            raise JWTError("token header has no valid key id")
+        entry = self._verify_keys.get(kid)
+        if entry is None:
+            raise JWTError("unknown signing key")
+        algorithm, key = entry
+        return jwt.decode(token, key, algorithms=[algorithm])
@@ -0,0 +1,102 @@
+# Startup warm-up for the identity service.
+#
+# Everything the first requests after a rollout would otherwise pay for
+# lazily — new Postgres connections, first executions of the hot
+# statements, bcrypt worker processes and their CryptContext, JWT key and
+# crypto-backend setup, the response serializers — runs once as a list of
+# named steps before the pod takes traffic. main.py registers the steps;
+# lifespan starts run() as a background task, so the server is already
+# listening while it works and /healthz/startup can report progress:
+#
+#   {"status": "starting", "steps": {"db_pool": "done", "bcrypt": "running", ...}}
+#
+# The startup probe gates the liveness and readiness probes, so no traffic
+# arrives before every step has finished. A failing step marked
+# `critical` leaves the pod "failed" (503 until the kubelet restarts it);
+# other failures are logged and startup carries on, e.g. a database that
+# isn't up yet is reported by readiness instead. A step registered with
+# `retry_on` exception types is run again, with exponential backoff up
+# to `RETRY_MAX_DELAY`, for as long as it fails with one of them (its
+# state reads "retrying: ..." meanwhile). Startup waits for it; if that
+# takes longer than the startup probe allows, the kubelet restarts the pod.
+import asyncio
+import time
+
+RETRY_FIRST_DELAY = 0.5
+RETRY_MAX_DELAY = 10.0
+
+
+class WarmUp:
+    def __init__(self, log=None):
+        self.log = log  # log(level, message, **fields)
+        self._steps = []  # (name, fn, critical, retry_on)
+        self.state = {}  # name -> pending | running | done | failed: ...
+        self.done = False
+        self.failed = False
+        self.seconds = None
+        self._task = None
+
+    def step(self, name: str, critical: bool = True, retry_on=()):
+        """Decorator registering `async def fn()` as the next step."""
+        def register(fn):
+            self._steps.append((name, fn, critical, tuple(retry_on)))
+            self.state[name] = "pending"
+            return fn
+        return register
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def status(self) -> dict:
+        status = "failed" if self.failed else "started" if self.done else "starting"
+        body = {"status": status, "steps": dict(self.state)}
+        if self.seconds is not None:
+            body["seconds"] = self.seconds
+        return body
+
+    async def run(self):
+        started = time.monotonic()
+        for name, fn, critical, retry_on in self._steps:
+            self.state[name] = "running"
+            step_started = time.monotonic()
+            try:
+                await self._attempt(name, fn, retry_on)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.state[name] = f"failed: {e}"
+                self._log("ERROR" if critical else "WARN", f"Warm-up step {name} failed: {e}", step=name)
+                if critical:
+                    self.failed = True
+                    return
+                continue
+            self.state[name] = "done"
+            self._log("INFO", f"Warm-up step {name} done", step=name,
+                      ms=round((time.monotonic() - step_started) * 1000, 1))
+        self.seconds = round(time.monotonic() - started, 3)
+        self.done = True
+        self._log("INFO", "Warm-up complete", seconds=self.seconds)
+
+    async def _attempt(self, name, fn, retry_on):
+        delay = RETRY_FIRST_DELAY
+        while True:
+            try:
+                return await fn()
+            except retry_on as e:
+                self.state[name] = f"retrying: {e}"
+                self._log("WARN", f"Warm-up step {name} failed, retrying in {delay:g}s: {e}", step=name)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+
+    def _log(self, level, message, **fields):
+        if self.log is not None:
+            self.log(level, message, **fields)
@@ -4,10 +4,11 @@
 #      4 StatefulSets, 4 headless SVCs, 5 app Deployments + frontend,
 #      probes, resources, PDBs, seed jobs, Gateway, HTTPRoutes,
 #      ReferenceGrant, MetalLB IP pool, observability stack
-#   2. (Stage 7) ~25 new: metrics-server, VPA components, HPA, VPA,
+#   2. (Stage 7) ~30 new: metrics-server, VPA components, HPA, VPA,
 #      PriorityClass, PriorityClass on booking/notification, search
 #      tolerations + nodeAffinity, Redis cache HIT/MISS, X-Cache header,
-#      cache_hits_total + cache_misses_total counters
+#      cache_hits_total + cache_misses_total counters, identity schema
+#      migrations + EXPLAIN checks on the login / listing indexes
 #
 # Usage:
 #   ./scripts/verify.sh                       # full suite
@@ -474,6 +475,176 @@ if [[ "$SKIP_STAGE7" != "true" && "$SKIP_WORKLOADS" != "true" ]]; then
             fail "redis has 0 search:* keys (cache miss above should have written one)"
         fi
     fi
+    step "Stage 7 — identity schema migrations + planner index choice"
+    # The identity service applies code/identity/migrations/ at startup.
+    # enable_seqscan=off: with a handful of seeded rows a seq scan is the
+    # cheaper plan, so this checks the indexes can serve the queries at
+    # all — login as an index-only scan on the covering index, the admin
+    # listing as an ordered scan with no sort.
+    idb_pod=$(kubectl get pods -n apollo-airlines-apps -l app=identity-db -o jsonpath='{.items[0].metadata.name}' 2>/dev/null || echo "")
+    if [[ -z "$idb_pod" ]]; then
+        fail "no identity-db pod found"
+    else
+        idb_psql() {
+            kubectl exec -n apollo-airlines-apps "$idb_pod" -- \
+                psql -U postgres -d identity -qAt -c "SET enable_seqscan = off" -c "$1" 2>/dev/null || echo ""
+        }
+        expected=$(find "$STAGE_DIR/code/identity/migrations" -name '*.sql' | wc -l | tr -d ' ')
+        applied=$(idb_psql "SELECT count(*) FROM schema_migrations")
+        if [[ "$applied" == "$expected" ]]; then
+            pass "identity-db has all $expected migrations applied"
+        else
+            fail "identity-db has '$applied' of $expected migrations applied"
+        fi
+
+        login_plan=$(idb_psql "EXPLAIN SELECT id, email, password_hash, role, loyalty_tier, is_active FROM users WHERE email = 'admin@apolloairlines.com' AND password_hash <> ''")
+        if echo "$login_plan" | grep -q "Index Only Scan using users_email_login_idx"; then
+            pass "login lookup is an index-only scan on users_email_login_idx"
+        else
+            fail "login lookup plan: $(echo "$login_plan" | head -1)"
+        fi
+
+        # EXPLAIN the listing exactly as queries.list_users builds it (first
+        # page, no filters), taken from the identity pod's own queries.py.
+        listing_pod=$(kubectl get pods -n apollo-airlines-apps -l app=identity -o jsonpath='{.items[0].metadata.name}' 2>/dev/null || echo "")
+        listing_sql=$(kubectl exec -n apollo-airlines-apps "$listing_pod" -- python -c '
+import queries
+sql, params = queries._user_listing(["email"], None, None, None, None)
+print(sql + " LIMIT 101")
+' 2>/dev/null || echo "")
+        listing_plan=$(idb_psql "EXPLAIN $listing_sql")
+        if echo "$listing_plan" | grep -q "users_created_at_id_idx" && ! echo "$listing_plan" | grep -q "Sort"; then
+            pass "admin listing walks users_created_at_id_idx without a sort"
+        else
+            fail "admin listing plan: $(echo "$listing_plan" | head -2 | tr '\n' ' ')"
+        fi
+
+        upper=$(idb_psql "SELECT count(*) FROM users WHERE email <> lower(email)")
+        if [[ "$upper" == "0" ]]; then
+            pass "identity-db emails are all lowercase"
+        else
+            fail "identity-db has '$upper' emails with uppercase letters"
+        fi
+
+        created_nullable=$(idb_psql "SELECT is_nullable FROM information_schema.columns WHERE table_name = 'users' AND column_name = 'created_at'")
+        if [[ "$created_nullable" == "NO" ]]; then
+            pass "users.created_at is NOT NULL"
+        else
+            fail "users.created_at is_nullable = '$created_nullable' (expected NO)"
+        fi
+    fi
+
+    step "Stage 7 — identity pool saturation marks the pod unready"
+    # 20 slow queries through a 2-connection pool: the DB executor has one
+    # thread per connection, so 18 callers wait in its queue, not in
+    # checkout. They must count as waiters and trip max_db_waiters. Runs
+    # the service's own db.py / readiness.py in the pod against
+    # identity-db, outside the serving workers (and their metrics dir).
+    identity_pod=$(kubectl get pods -n apollo-airlines-apps -l app=identity -o jsonpath='{.items[0].metadata.name}' 2>/dev/null || echo "")
+    if [[ -z "$identity_pod" ]]; then
+        fail "no identity pod found"
+    else
+        saturation=$(kubectl exec -n apollo-airlines-apps "$identity_pod" -- env -u PROMETHEUS_MULTIPROC_DIR python -c '
+import asyncio, os
+from types import SimpleNamespace
+from db import ConnectionPool
+from readiness import ReadinessMonitor
+
+class NoCache:
+    async def status(self):
+        return "disabled"
+
+def sleep(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT pg_sleep(0.5)")
+    cur.close()
+
+async def main():
+    pool = ConnectionPool(os.environ["DATABASE_URL"], max_size=2, acquire_timeout=30)
+    monitor = ReadinessMonitor(pool, lambda conn: None, SimpleNamespace(broken=False, pending=0, max_pending=1),
+                               NoCache(), timeout=0.1, max_db_waiters=10, saturated_checks=1)
+    calls = [asyncio.ensure_future(pool.run(sleep)) for _ in range(20)]
+    await asyncio.sleep(0.2)
+    waiters = pool.stats()["waiters"]
+    await monitor._check()
+    await asyncio.gather(*calls)
+    print(waiters, "; ".join(monitor.reasons) or "ready")
+    pool.close()
+
+asyncio.run(main())
+' 2>/dev/null | tail -1 || echo "")
+        # The ping (timeout 0.1s) queues behind the sleeps too; what matters
+        # is the waiters reason.
+        if echo "$saturation" | grep -q "requests waiting for a database connection"; then
+            pass "saturated identity pool reports unready: $saturation"
+        else
+            fail "saturated identity pool not reported as waiting: '$saturation'"
+        fi
+    fi
+
+    step "Stage 7 — identity fast lane answers a wrong method with 405"
+    # Only GETs on probe paths take the fast lane; anything else must
+    # go through ExceptionMiddleware and come back 405, not 500.
+    if [[ -z "$identity_pod" ]]; then
+        fail "no identity pod found"
+    else
+        wrong_method=$(kubectl exec -n apollo-airlines-apps "$identity_pod" -- python -c '
+import os, urllib.error, urllib.request
+req = urllib.request.Request("http://127.0.0.1:%s/healthz" % os.environ["PORT"], data=b"", method="POST")
+try:
+    print(urllib.request.urlopen(req, timeout=5).status)
+except urllib.error.HTTPError as e:
+    print(e.code)
+' 2>/dev/null | tail -1 || echo "")
+        if [[ "$wrong_method" == "405" ]]; then
+            pass "POST /healthz -> 405"
+        else
+            fail "POST /healthz returned '$wrong_method' (expected 405)"
+        fi
+    fi
+
+    step "Stage 7 — identity shared cache on the memory:// stand-in"
+    # REDIS_URL=memory:// must support every call SharedProfileCache makes;
+    # a missing one shows up as an on_error("<op>", ...) report. Also checks
+    # that a refill racing an invalidation is never served.
+    if [[ -z "$identity_pod" ]]; then
+        fail "no identity pod found"
+    else
+        memory_cache=$(kubectl exec -n apollo-airlines-apps "$identity_pod" -- python -c '
+import asyncio
+from cache import SharedProfileCache
+
+async def main():
+    errors = []
+    shared = SharedProfileCache("memory://", ttl=60, on_error=lambda op, e: errors.append(f"{op}: {e!r}"))
+    await shared.connect()
+    _, version = await shared.get("u1")
+    await shared.put("u1", {"id": "u1", "email": "a@example.com", "password_hash": "x"}, version)
+    row, _ = await shared.get("u1")
+    # A read that started before this invalidation writes its row back
+    # afterwards: it must not be served.
+    _, before = await shared.get("u1")
+    await shared.delete("u1")
+    await shared.publish_invalidation("u1")
+    await shared.put("u1", {"id": "u1", "email": "old@example.com"}, before)
+    stale, _ = await shared.get("u1")
+    if errors:
+        print("errors:", "; ".join(errors))
+    elif row != {"id": "u1", "email": "a@example.com"}:
+        print("bad round trip:", row)
+    elif stale is not None:
+        print("stale refill served:", stale)
+    else:
+        print("ok")
+
+asyncio.run(main())
+' 2>/dev/null | tail -1 || echo "")
+        if [[ "$memory_cache" == "ok" ]]; then
+            pass "memory:// shared cache: round trip, invalidation and no stale refill"
+        else
+            fail "memory:// shared cache: '$memory_cache'"
+        fi
+    fi
 fi
 
 # =============================================================================